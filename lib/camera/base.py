@@ -17,12 +17,22 @@
 # System imports
 import sys
 import os
+import threading
 from typing import *
 import cv2 as cv
 import numpy as np
 import importlib as imp
-from threads import KillableThread
-from flush import flush
+from threads import KillableThread, StopToken
+from camera.ring import FrameRing
+from camera.recorder import VideoRecorder, DROP_OLDEST
+from camera.stream import FrameStreamer
+from camera.overlay import OverlayRenderer
+from camera.calib import Calibration
+from flush import flush, durability
+from timing import StageTimer
+from settings import parse_settings
+from vision.images import new_frame
+from vision.base import VisionBase
 from collections import namedtuple
 import time
 
@@ -54,7 +64,11 @@ def load_cscore():
 
 
 # Set global variables
-calibration_dir = team4121home + "config" + team4121config
+calibration_dir = team4121home + "/config/" + team4121config
+
+# Stages timed by every camera in profile mode, followed by one stage per vision library
+profile_stages = ("capture", "preprocess", "stream", "video", "callback")
+STAGE_CAPTURE, STAGE_PREPROCESS, STAGE_STREAM, STAGE_VIDEO, STAGE_CALLBACK = range(5)
 
 CameraParams = namedtuple(
     "CameraParams",
@@ -62,6 +76,32 @@ CameraParams = namedtuple(
     defaults=(False, False, True, True, None),
 )
 
+# Where a set of results came from: `frameId` counts up with every frame the camera captures, `captureTime`
+# is when the frame was captured (`time.monotonic()`), and `latency` is how long after that (in seconds)
+# the results were ready
+FrameInfo = namedtuple("FrameInfo", ("frameId", "captureTime", "latency"))
+
+# Camera settings that can change while the camera is running (FOV, ROI_* and UNDISTORT)
+# `roi` is the region of interest the vision libraries process, as (x0, y0, x1, y1), and `roiMask` marks
+# the pixels inside it if it's a polygon
+# `undistort` remaps every frame, or with `undistortRoi` only the region of interest, using `undistortMaps`
+# and writing into `undistortBuffer`
+# `frameMatrix` and `frameDist` describe the images the vision libraries get
+FrameParams = namedtuple(
+    "FrameParams",
+    (
+        "fov",
+        "roi",
+        "roiMask",
+        "undistort",
+        "undistortRoi",
+        "undistortMaps",
+        "undistortBuffer",
+        "frameMatrix",
+        "frameDist",
+    ),
+)
+
 
 # This is the base camera, from which all of our cameras inherit
 # The default initializer should probably be called before the rest of the initializer in derived classes
@@ -69,10 +109,18 @@ CameraParams = namedtuple(
 # The derived camera's module must first be loaded
 class CameraBase:
     config = {"": {}}
+    # A config being compiled by `swap_config`, which `get_config` reads on that thread instead of `config`
+    compiling = threading.local()
     init = False
     stream = cscore_available
     save = True
     types = {}
+    # Whether to read frames on a dedicated capture thread by default (CAPTURE_THREAD overrides this)
+    threadedCapture = False
+    # Called with the stage percentiles whenever the profiler dumps them
+    profilePublish = None
+    # Called from the camera's thread when a camera that can run out of frames (VIDEO) does and stops
+    onEnd = None
 
     # Define initialization
     def __init__(
@@ -81,9 +129,9 @@ class CameraBase:
         self.name = name
         self.enabled = params.enabled
         if not CameraBase.stream:
-            params.csname = False
+            params = params._replace(csname=False)
         if not CameraBase.save:
-            params.videofile = None
+            params = params._replace(videofile=None)
         self.profile = params.profile
         self.name = name
 
@@ -103,18 +151,20 @@ class CameraBase:
             raise e
 
         self.log_file = open(logFilename, "a")
+        durability.register(self.log_file)
         self.log_file.write(f"CAMLOG: {logFilename}\n")
         self.log_file.write("Initializing webcam: {}\n".format(self.name))
-        # Initialize instance variables
-        self.undistort_img = False
 
         # Store frame size
         self.height = int(self.get_config("HEIGHT", 240))
         self.width = int(self.get_config("WIDTH", 320))
-        self.fov = float(self.get_config("FOV", 0.0))
         self.fps = int(self.get_config("FPS", 30))
         self.streamRes = int(self.get_config("STREAM_RES", 1))
+        self.streamFps = float(self.get_config("STREAM_FPS", self.fps))
         self.cropBottom = int(self.get_config("CROP_BOTTOM", 0))
+        self.threadedCapture = (
+            int(self.get_config("CAPTURE_THREAD", int(self.threadedCapture))) != 0
+        )
 
         # Set up video writer
         if type(params.videofile) is bool:
@@ -127,6 +177,7 @@ class CameraBase:
         else:
             self.videoFilename = params.videofile
 
+        self.recorder = None
         if self.videoFilename is None:
             self.camWriter = None
             self.saveVideo = False
@@ -154,6 +205,16 @@ class CameraBase:
             if self.camWriter.isOpened():
                 self.saveVideo = True
                 self.log_file.write("Video writer is open\n")
+                durability.register(self.videoFilename)
+                self.recorder = VideoRecorder(
+                    self.camWriter,
+                    (self.height, self.width, 3),
+                    queueSize=int(self.get_config("RECORD_QUEUE", 8)),
+                    policy=self.get_config("RECORD_POLICY", DROP_OLDEST).upper(),
+                    every=int(self.get_config("RECORD_EVERY", 1)),
+                    log_file=self.log_file,
+                    name=f"{self.name}_recorder",
+                )
             else:
                 self.saveVideo = False
                 self.log_file.write("Video writer is NOT open\n")
@@ -162,26 +223,39 @@ class CameraBase:
         self.frame = np.zeros(shape=(self.height, self.width, 3), dtype=np.uint8)
 
         self.grabbed = True
-        self.kill = False
+        self.stopToken = StopToken()
+        self.ring = None
+        self.captureThread = None
+        self.process = None
+        self.processParams = None
+        self.processConfig = None
+        self.timer = None
+        self.frameSeq = 0
+        self.frameTime = time.monotonic()
+        self.frameAge = 0.0
+        self.captureTime = None
         self.printException = True
 
-        # Read camera calibration files
-        # cam_matrix_file = (
-        #     calibration_dir + "/Camera_Matrix_Cam" + str(self.device_id) + ".txt"
-        # )
-        # cam_coeffs_file = (
-        #     calibration_dir + "/Distortion_Coeffs_Cam" + str(self.device_id) + ".txt"
-        # )
-        # if (
-        #    os.path.isfile(cam_matrix_file) == True
-        #    and os.path.isfile(cam_coeffs_file) == True
-        # ):
-        #    self.cam_matrix = np.loadtxt(cam_matrix_file)
-        #    self.distort_coeffs = np.loadtxt(cam_coeffs_file)
-        #    self.undistort_img = True
+        # Read camera calibration files (CALIBRATION is the N in Camera_Matrix_CamN.txt)
+        self.calibration = None
+        calib = self.get_config("CALIBRATION", None)
+        if calib is not None:
+            self.calibration = Calibration.load(
+                calibration_dir,
+                calib.strip(),
+                (
+                    int(self.get_config("CALIB_WIDTH", self.width)),
+                    int(self.get_config("CALIB_HEIGHT", self.height)),
+                ),
+            )
+            if self.calibration is None:
+                self.log_file.write(f"Calibration {calib} not found in {calibration_dir}\n")
+        self.reload()
 
         if type(params.csname) is bool and params.csname:
-            params.csname = self.get_config("NTNAME", self.name.lower())
+            params = params._replace(
+                csname=self.get_config("NTNAME", self.name.lower())
+            )
 
         if params.csname is not False:
             load_cscore()
@@ -192,8 +266,22 @@ class CameraBase:
                 self.height // self.streamRes,
                 self.fps,
             )
+            self.streamer = FrameStreamer(
+                self.cvs,
+                (self.height, self.width, 3),
+                scale=self.streamRes,
+                fps=self.streamFps,
+                overlay=(
+                    OverlayRenderer(scale=self.streamRes)
+                    if int(self.get_config("STREAM_OVERLAY", 1)) != 0
+                    else None
+                ),
+                log_file=self.log_file,
+                name=f"{self.name}_stream",
+            )
         else:
             self.cvs = None
+            self.streamer = None
 
         pipes = self.get_config("VLIBS", "!")
         if len(pipes) > 0 and pipes[0] == "!":
@@ -204,53 +292,52 @@ class CameraBase:
         self.pipes = {s.strip() for s in pipes.split(",")}
         self.cameraCounter = 0
 
+    # Setting `kill` stops every thread running for this camera
+    @property
+    def kill(self) -> bool:
+        return self.stopToken.stopped
+
+    @kill.setter
+    def kill(self, value: bool):
+        if value:
+            self.stopToken.stop()
+
+    # Read the camera settings file
+    # With `reload`, the settings are read again and replace the old ones as a whole; to change them under
+    # running cameras, use `swap_config` instead
     @staticmethod
     def read_config_file(file, reload: bool = False) -> bool:
         if CameraBase.init and not reload:
             return True
         CameraBase.init = True
-        # Declare local variables
-        value_section = ""
-        # Open the file and read contents
-        try:
-            # Open the file for reading
-            in_file = open(file, "r")
-
-            # Read in all lines
-            value_list = in_file.readlines()
-
-            # Process list of lines
-            for line in value_list:
-                # Remove trailing newlines and whitespace
-                clean_line = line.strip()
-                if len(clean_line) == 0:
-                    continue
-
-                if clean_line[0] == "#":
-                    continue
-                # Split the line into parts
-                split_line = clean_line.split("=")
-                # Determine section of the file we are in
-                upper_line = split_line[0].upper()
-
-                if upper_line[-1] == ":":
-                    value_section = upper_line[:-1]
-                    if not value_section in CameraBase.config:
-                        CameraBase.config[value_section] = {}
-                elif split_line[0] == "":
-                    value_section = ""
-                    if not value_section in CameraBase.config:
-                        CameraBase.config[value_section] = {}
-                else:
-                    CameraBase.config[value_section][split_line[0].upper()] = (
-                        split_line[1]
-                    )
-
-        except FileNotFoundError:
+        config = parse_settings(file)
+        if config is None:
             return False
-
+        CameraBase.config = config
         return True
 
+    # Replace the whole config, and recompile the frame parameters of `cams` with it
+    # Every camera is compiled against the new config before anything is assigned, so if one of them fails,
+    # the error is raised and the old config and parameters all stay as they were
+    @staticmethod
+    def swap_config(
+        config: Dict[str, Dict[str, str]], cams: Sequence["CameraBase"] = ()
+    ):
+        CameraBase.compiling.config = config
+        try:
+            params = [cam.compile_params() for cam in cams]
+        finally:
+            CameraBase.compiling.config = None
+        CameraBase.config = config
+        for cam, p in zip(cams, params):
+            cam.frameParams = p
+
+    # The config settings are read from: the one being compiled on this thread, if any, or else `config`
+    @staticmethod
+    def current_config() -> Dict[str, Dict[str, str]]:
+        config = getattr(CameraBase.compiling, "config", None)
+        return CameraBase.config if config is None else config
+
     @staticmethod
     def init_cam(name: str, timestamp: str, params: CameraParams = CameraParams()):
         ty = None
@@ -269,55 +356,202 @@ class CameraBase:
         return ty(name, timestamp, params)
 
     # Override point for camera
-    def read_frame_raw(self) -> Tuple[bool, np.ndarray]:
+    # If `out` is given, the frame should be read into it when possible (it's a preallocated buffer)
+    # Cameras should set `captureTime` to `time.monotonic()` as soon as the frame is captured, before
+    # decoding or converting it; if they don't, the time `read_frame_raw` returned is used instead
+    def read_frame_raw(
+        self, out: Optional[np.ndarray] = None
+    ) -> Tuple[bool, np.ndarray]:
         return False, np.zeros((self.width, self.height, 3))
 
     # Some cameras (currently only USB) need further initalization to run after all of the cameras have been initialized. This method will run this.
     def post_init(self):
         pass
 
+    # Compile the settings that can change while running into `FrameParams`
+    # Only settings that don't need the camera reopened are included; the rest are read once at startup
+    def compile_params(self) -> FrameParams:
+        roi, roiMask = self.read_roi()
+        return FrameParams(
+            float(self.get_config("FOV", 0.0)), roi, roiMask, *self.read_undistort(roi)
+        )
+
+    # Recompile the frame parameters from the current settings
+    # They're swapped in with a single assignment, so each frame sees either the old or the new parameters,
+    # never a mix, and the vision loop doesn't need to take a lock to read them
+    def reload(self) -> FrameParams:
+        self.frameParams = self.compile_params()
+        return self.frameParams
+
+    # Read the region of interest that vision libraries process, as (x0, y0, x1, y1), along with a mask
+    # for the pixels inside it if it's a polygon
+    # ROI_TOP/BOTTOM/LEFT/RIGHT crop that many pixels from each edge (CROP_BOTTOM is the same as ROI_BOTTOM),
+    # and ROI_POLY is a list of "x,y" points separated by ";"
+    def read_roi(self) -> Tuple[Tuple[int, int, int, int], Optional[np.ndarray]]:
+        x0 = int(self.get_config("ROI_LEFT", 0))
+        y0 = int(self.get_config("ROI_TOP", 0))
+        x1 = self.width - int(self.get_config("ROI_RIGHT", 0))
+        y1 = self.height - int(
+            self.get_config("ROI_BOTTOM", self.get_config("CROP_BOTTOM", 0))
+        )
+        mask = None
+        poly = self.get_config("ROI_POLY", None)
+        if poly is not None:
+            points = np.array(
+                [[int(v) for v in point.split(",")] for point in poly.split(";")],
+                dtype=np.int32,
+            )
+            px, py, pw, ph = cv.boundingRect(points)
+            x0, y0 = max(x0, px), max(y0, py)
+            x1, y1 = min(x1, px + pw), min(y1, py + ph)
+        x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+        if poly is not None:
+            mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv.fillPoly(mask, [points - (x0, y0)], 255)
+        return (x0, y0, x1, y1), mask
+
+    # Set up undistortion with precomputed remap tables, for the `FrameParams` fields from `undistort` on
+    # UNDISTORT=1 remaps every frame, while UNDISTORT=ROI only remaps the region of interest for the
+    # vision libraries (the stream and recording stay distorted)
+    def read_undistort(self, roi: Tuple[int, int, int, int]) -> tuple:
+        mode = self.get_config("UNDISTORT", "0").strip().upper()
+        undistort = self.calibration is not None and mode not in ("", "0")
+        undistortRoi = undistort and mode == "ROI"
+        if undistort:
+            map1, map2, frameMatrix = self.calibration.undistort_maps(
+                self.width, self.height
+            )
+            if undistortRoi:
+                x0, y0, x1, y1 = roi
+                map1 = np.ascontiguousarray(map1[y0:y1, x0:x1])
+                map2 = np.ascontiguousarray(map2[y0:y1, x0:x1])
+            return (
+                True,
+                undistortRoi,
+                (map1, map2),
+                np.zeros((*map2.shape, 3), dtype=np.uint8),
+                frameMatrix,
+                None,
+            )
+        if self.calibration is not None:
+            return (
+                False,
+                False,
+                None,
+                None,
+                self.calibration.matrix(self.width, self.height),
+                self.calibration.distCoeffs,
+            )
+        return False, False, None, None, None, None
+
     # Get a camera configuration value
     def get_config(self, name: str, default: str) -> str:
-        if self.name in CameraBase.config:
-            cfg = CameraBase.config[self.name]
+        config = CameraBase.current_config()
+        if self.name in config:
+            cfg = config[self.name]
             if name in cfg:
                 return cfg[name]
-        cfg = CameraBase.config[""]
+        cfg = config[""]
         if name in cfg:
             return cfg[name]
         return default
 
+    # Start reading frames on their own thread, into a ring of preallocated buffers
+    def start_capture(self):
+        self.ring = FrameRing(
+            (self.height, self.width, 3), size=int(self.get_config("CAPTURE_RING", 3))
+        )
+        self.captureThread = KillableThread(
+            target=self._capture_fn,
+            name=f"{self.name}_capture",
+            token=self.stopToken,
+        )
+        self.captureThread.daemon = True
+        self.captureThread.start()
+
+    def _capture_fn(self):
+        token = self.stopToken
+        ring = self.ring
+        while not token.stopped:
+            buf = ring.write_buffer()
+            self.captureTime = None
+            try:
+                good, frame = self.read_frame_raw(buf)
+            except Exception as read_error:
+                good = False
+                if self.printException:
+                    self.printException = False
+                    self.log_file.write(
+                        "Error capturing video:\n    type: {}\n    args: {}\n    {}\n".format(
+                            type(read_error), read_error.args, read_error
+                        )
+                    )
+            stamp = self.captureTime
+            if stamp is None:
+                stamp = time.monotonic()
+            if not good:
+                token.wait(0.01)
+                continue
+            if frame is not buf:
+                if frame.shape == buf.shape:
+                    np.copyto(buf, frame)
+                else:
+                    ring.replace(frame)
+            ring.publish(stamp)
+
+    # Get the next frame to process, either from the capture thread or by reading it directly
+    def grab_frame(self) -> Tuple[bool, np.ndarray]:
+        if self.threadedCapture:
+            if self.ring is None:
+                self.start_capture()
+            res = self.ring.wait(self.frameSeq, max(4.0 / self.fps, 0.1))
+            # Time spent waiting for the capture thread is idle, not part of capturing
+            if self.timer is not None:
+                self.timer.skip()
+            if res is None:
+                return False, self.frame
+            self.frameSeq, self.frameTime, frame = res
+        else:
+            self.captureTime = None
+            good, frame = self.read_frame_raw()
+            if not good:
+                return False, frame
+            self.frameSeq += 1
+            self.frameTime = self.captureTime
+            if self.frameTime is None:
+                self.frameTime = time.monotonic()
+        self.frameAge = time.monotonic() - self.frameTime
+        return True, frame
+
     # Grab a frame from the camera, possibly with some preprocessing
     # post_init MUST be called first!
-    def read_frame(self) -> np.ndarray:
-        # Declare frame for undistorted image
-        # newFrame = np.zeros(shape=(self.height, self.width, 3), dtype=np.uint8)
-
+    # `params` are the frame parameters to use, if the caller has already read them for this frame
+    # If `stream` is false, the frame isn't sent to the stream (`use_libs` sends it with its results)
+    def read_frame(
+        self, params: Optional[FrameParams] = None, stream: bool = True
+    ) -> np.ndarray:
+        if params is None:
+            params = self.frameParams
+        timer = self.timer
         try:
             # Grab new frame
-            self.grabbed, frame = self.read_frame_raw()
+            self.grabbed, frame = self.grab_frame()
+            if timer is not None:
+                timer.lap(STAGE_CAPTURE)
 
             if not self.grabbed:
                 return self.frame
             self.frame = frame
             # Undistort image
-            if self.undistort_img == True:
-                h, w = self.frame.shape[:2]
-                new_matrix, roi = cv.getOptimalNewCameraMatrix(
-                    self.cam_matrix, self.distort_coeffs, (w, h), 1, (w, h)
-                )
-                newFrame = cv.undistort(
-                    frame, self.cam_matrix, self.distort_coeffs, None, new_matrix
+            if params.undistort and not params.undistortRoi:
+                self.frame = cv.remap(
+                    frame,
+                    *params.undistortMaps,
+                    cv.INTER_LINEAR,
+                    dst=params.undistortBuffer,
                 )
-                x, y, w, h = roi
-                self.frame = self.frame[y : y + h, x : x + w]
-            cv.rectangle(
-                self.frame,
-                (0, self.height - self.cropBottom),
-                (self.width, self.height),
-                (0, 0, 0),
-                -1,
-            )
+            if timer is not None:
+                timer.lap(STAGE_PREPROCESS)
             self.printException = True
         except Exception as read_error:
             if self.printException:
@@ -329,71 +563,173 @@ class CameraBase:
                     )
                 )
 
-        if self.cvs is not None:
-            self.cvs.putFrame(
-                cv.resize(
-                    self.frame,
-                    (self.width // self.streamRes, self.height // self.streamRes),
-                )
-            )
+        if stream and self.streamer is not None:
+            self.streamer.submit(self.frame)
+            if timer is not None:
+                timer.lap(STAGE_STREAM)
         self.write_video(self.frame)
+        if timer is not None:
+            timer.lap(STAGE_VIDEO)
 
         # Return the most recent frame
         return self.frame
 
     # Write a frame to the video file
+    # The frame is only queued here; the recorder encodes it on its own thread
+    # The log is handed to the OS every 50 frames, and `durability` syncs it to disk in the background
     def write_video(self, img: np.ndarray):
-        # Check if write is opened
-        if self.camWriter is not None and self.camWriter.isOpened():
-            # Write the image
-            try:
-                self.camWriter.write(img)
-            except Exception as write_error:
-                # Print exception info
-                self.log_file.write(
-                    "Error writing video:\n    type: {}\n    args: {}\n    {}\n".format(
-                        type(write_error), write_error.args, write_error
-                    )
-                )
+        if self.recorder is not None:
+            self.recorder.write(img)
             if self.cameraCounter < 50:
                 self.cameraCounter += 1
             else:
                 self.cameraCounter = 0
                 self.log_file.flush()
-                flush()
 
     # Release all camera resources
     def close(self):
-        # Release video writer
-        cw = getattr(self, "camWriter", None)
-        if cw is not None:
-            cw.release()
+        # Stop the capture thread before anything it uses goes away
+        if self.captureThread is not None:
+            self.stopToken.stop()
+            self.captureThread.join(1.0)
+
+        if self.process is not None:
+            self.process.close()
+
+        if self.streamer is not None:
+            self.streamer.close()
+            self.log_file.write(
+                "Streamed {} of {} frames offered\n".format(
+                    self.streamer.streamed, self.streamer.submitted
+                )
+            )
+
+        # Release video writer, after the recorder has written out its queue
+        recorder = getattr(self, "recorder", None)
+        if recorder is not None:
+            recorder.close()
+            self.log_file.write(
+                "Recorded {} of {} frames ({} dropped, {} skipped)\n".format(
+                    recorder.written,
+                    recorder.submitted,
+                    recorder.dropped,
+                    recorder.skipped,
+                )
+            )
+        else:
+            cw = getattr(self, "camWriter", None)
+            if cw is not None:
+                cw.release()
+        if self.videoFilename is not None:
+            durability.unregister(self.videoFilename)
+
+        if self.ring is not None:
+            self.log_file.write(
+                "Captured {} frames, {} dropped as stale\n".format(
+                    self.ring.seq, self.ring.dropped
+                )
+            )
 
         # Close the log file
         self.log_file.write("Webcam closed. Video writer closed.\n")
+        durability.unregister(self.log_file)
         self.log_file.close()
 
+    # Run this camera's vision processors in their own worker process instead of the calling thread
+    # The libraries passed to `use_libs` are then ignored in favor of these
+    # Must be called before any of this camera's threads are started
+    # The worker's frame buffer is the full frame size, so any region of interest fits after a reload
+    def use_process(self, *libs):
+        from vision.process import VisionProcess
+
+        params = self.frameParams
+        self.process = VisionProcess(
+            [lib for lib in libs if (lib.name in self.pipes) != self.blacklist],
+            (self.height, self.width, 3),
+            name=f"{self.name}_vision",
+            mask=params.roiMask,
+            calibration=(params.frameMatrix, params.frameDist),
+            log_file=self.log_file,
+        )
+        self.processParams = params
+        self.processConfig = VisionBase.config
+
+    # Hand reloaded settings to the worker process, if there are any it hasn't seen
+    # Runs on the vision thread between frames, since it shares the worker's pipe with `find_objects`
+    def update_process(self, params: FrameParams):
+        config = VisionBase.config
+        if params is self.processParams and config is self.processConfig:
+            return
+        self.process.reload(
+            config, params.roiMask, (params.frameMatrix, params.frameDist)
+        )
+        self.processParams = params
+        self.processConfig = config
+
     # Apply vision processors to a single frame
-    def use_libs(self, *libs, sleep_if_fail: float = 0.0) -> Tuple[np.ndarray, dict]:
+    # Returns the frame, the results of each library, and the `FrameInfo` of the frame (None if there's
+    # no new frame)
+    def use_libs(
+        self, *libs, sleep_if_fail: float = 0.0
+    ) -> Tuple[np.ndarray, dict, Optional[FrameInfo]]:
         try:
             if self.enabled:
-                frame = self.read_frame()
+                # Read the parameters once, so a reload can't change them partway through the frame
+                params = self.frameParams
+                frame = self.read_frame(params, stream=False)
                 if self.grabbed:
-                    return (
-                        frame,
-                        {
+                    # Libraries only look at the region of interest, and share images derived from it
+                    x0, y0, x1, y1 = params.roi
+                    if params.undistortRoi:
+                        view = cv.remap(
+                            frame,
+                            *params.undistortMaps,
+                            cv.INTER_LINEAR,
+                            dst=params.undistortBuffer,
+                        )
+                    else:
+                        view = frame[y0:y1, x0:x1]
+                    new_frame(
+                        view,
+                        (x0, y0),
+                        params.roiMask,
+                        params.frameMatrix,
+                        params.frameDist,
+                    )
+                    if self.process is not None:
+                        self.update_process(params)
+                    if self.timer is not None:
+                        res = self._find_objects_timed(view, libs, params)
+                    elif self.process is not None:
+                        res = self.process.find_objects(
+                            view, self.width, self.height, params.fov, (x0, y0)
+                        )
+                    else:
+                        res = {
                             lib.name: lib.find_objects(
-                                frame, self.width, self.height, self.fov
+                                view, self.width, self.height, params.fov
                             )
                             for lib in libs
                             if (lib.name in self.pipes) != self.blacklist
-                        },
+                        }
+                    if self.streamer is not None:
+                        self.streamer.submit(frame, res)
+                        if self.timer is not None:
+                            self.timer.lap(STAGE_STREAM)
+                    captureTime = self.frameTime
+                    return (
+                        frame,
+                        res,
+                        FrameInfo(
+                            self.frameSeq, captureTime, time.monotonic() - captureTime
+                        ),
                     )
-            time.sleep(sleep_if_fail)
+            if sleep_if_fail > 0.0:
+                self.stopToken.wait(sleep_if_fail)
         except Exception as e:
             self.log_file.write("Error: video processing failure.")
             self.log_file.write("Error message: {}\n".format(e))
-        return (self.frame, dict())
+        return (self.frame, dict(), None)
 
     def _use_libs_fn(self, callback, *libs):
         args = self.use_libs(*libs)
@@ -401,41 +737,57 @@ class CameraBase:
             callback(*args)
 
     def _loop_libs_fn(self, callback, *libs):
-        while not self.kill:
+        token = self.stopToken
+        while not token.stopped:
             args = self.use_libs(*libs, sleep_if_fail=0.01)
             if self.grabbed or not self.enabled:
                 callback(*args)
 
+    # Same as the vision part of `use_libs`, but timing each library
+    def _find_objects_timed(self, frame: np.ndarray, libs, params: FrameParams) -> dict:
+        timer = self.timer
+        if self.process is not None:
+            res = self.process.find_objects(
+                frame, self.width, self.height, params.fov, params.roi[:2]
+            )
+            timer.lap(timer.index["process"])
+            return res
+        res = {}
+        for lib in libs:
+            if (lib.name in self.pipes) != self.blacklist:
+                res[lib.name] = lib.find_objects(
+                    frame, self.width, self.height, params.fov
+                )
+                timer.lap(timer.index[lib.name])
+        return res
+
     def _loop_libs_fn_profile(self, callback, *libs):
-        self._loop_libs_fn(callback, *libs)
-        # TODO: make this work with new callback code
-        # frame = None
-
-        # def time_find(lib):
-        #     start = time.monotonic()
-        #     ret = lib.find_objects(frame, self.width, self.height, self.fov)
-        #     end = time.monotonic()
-        #     return str(end - start), ret
-
-        # with open(f"{team4121home}/logs/{self.name}_profile.csv", "w+") as f:
-        #     f.write("total,cam,vision,callback,{}\n".format(",".join(map(str, libs))))
-        #     while True:
-        #         t0 = time.monotonic()
-        #         frame = self.read_frame()
-        #         t1 = time.monotonic()
-        #         times, objs = tuple(map(list, zip(*map(time_find, libs))))
-        #         args = (frame, *objs)
-        #         t2 = time.monotonic()
-        #         if self.grabbed:
-        #             callback(*args)
-        #         t3 = time.monotonic()
-        #         f.write(
-        #             ",".join(
-        #                 [str(t3 - t0), str(t1 - t0), str(t2 - t1), str(t3 - t2), *times]
-        #             )
-        #             + "\n"
-        #         )
-        #         f.flush()
+        if self.process is not None:
+            names = ["process"]
+        else:
+            names = [
+                lib.name for lib in libs if (lib.name in self.pipes) != self.blacklist
+            ]
+        timer = StageTimer(
+            (*profile_stages, *names),
+            path=f"{team4121logs}/{self.name}_profile.csv",
+            dumpEvery=int(self.get_config("PROFILE_EVERY", 300)),
+            publish=self.profilePublish,
+        )
+        self.timer = timer
+        token = self.stopToken
+        try:
+            while not token.stopped:
+                timer.start()
+                args = self.use_libs(*libs, sleep_if_fail=0.01)
+                if self.grabbed or not self.enabled:
+                    callback(*args)
+                    timer.lap(STAGE_CALLBACK)
+                if self.grabbed and self.enabled:
+                    timer.end()
+        finally:
+            self.timer = None
+            timer.close()
 
     # Apply vision processors to a single frame, with a callback.
     # Made to easily switch with `use_libs_async`
@@ -449,7 +801,10 @@ class CameraBase:
         self, *libs, callback=lambda _: None, name: str = "vision"
     ) -> KillableThread:
         thread = KillableThread(
-            target=self._use_libs_fn, args=(callback, *libs), name=name
+            target=self._use_libs_fn,
+            args=(callback, *libs),
+            name=name,
+            token=self.stopToken,
         )
         thread.daemon = True
         thread.start()
@@ -462,6 +817,7 @@ class CameraBase:
             target=(self._loop_libs_fn_profile if self.profile else self._loop_libs_fn),
             args=(callback, *libs),
             name=name,
+            token=self.stopToken,
         )
         thread.daemon = True
         thread.start()
@@ -0,0 +1,85 @@
+import os
+import hashlib
+import cv2 as cv
+import numpy as np
+from typing import *
+
+team4121home = os.getenv("TEAM4121HOME", os.getcwd())
+team4121cache = os.getenv("TEAM4121CACHE", team4121home + "/cache")
+
+
+# A camera calibration, as written by `Utilities/Calibrate_Cam.py`
+# `size` is the resolution it was made at; matrices for other resolutions are scaled from it
+class Calibration:
+    def __init__(
+        self,
+        camMatrix: np.ndarray,
+        distCoeffs: np.ndarray,
+        size: Tuple[int, int],
+        digest: str,
+    ):
+        self.camMatrix = camMatrix
+        self.distCoeffs = distCoeffs
+        self.size = size
+        self.digest = digest
+        self.maps = {}
+
+    # Load Camera_Matrix_Cam<ident>.txt and Distortion_Coeffs_Cam<ident>.txt from a directory
+    @staticmethod
+    def load(directory: str, ident, size: Tuple[int, int]) -> Optional["Calibration"]:
+        matrixFile = f"{directory}/Camera_Matrix_Cam{ident}.txt"
+        coeffsFile = f"{directory}/Distortion_Coeffs_Cam{ident}.txt"
+        if not (os.path.isfile(matrixFile) and os.path.isfile(coeffsFile)):
+            return None
+        digest = hashlib.sha1()
+        for file in (matrixFile, coeffsFile):
+            with open(file, "rb") as f:
+                digest.update(f.read())
+        return Calibration(
+            np.loadtxt(matrixFile).reshape(3, 3),
+            np.loadtxt(coeffsFile).reshape(-1),
+            size,
+            digest.hexdigest()[:16],
+        )
+
+    # The camera matrix for frames of a given resolution
+    def matrix(self, width: int, height: int) -> np.ndarray:
+        mat = self.camMatrix.copy()
+        mat[0] *= width / self.size[0]
+        mat[1] *= height / self.size[1]
+        return mat
+
+    # Get the fixed-point maps for undistorting frames of a given resolution with `cv.remap`, along
+    # with the camera matrix of the undistorted frames
+    # Maps are computed once per resolution and cached on disk, keyed by the calibration's contents and the
+    # resolution it was made at (which the camera matrix is scaled from)
+    def undistort_maps(
+        self, width: int, height: int, alpha: float = 0.0
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        key = (width, height, alpha)
+        if key in self.maps:
+            return self.maps[key]
+        path = "{}/undistort_{}_{}x{}_{}x{}_{}.npz".format(
+            team4121cache, self.digest, *self.size, width, height, alpha
+        )
+        try:
+            with np.load(path) as cached:
+                maps = (cached["map1"], cached["map2"], cached["matrix"])
+        except (OSError, KeyError, ValueError):
+            mat = self.matrix(width, height)
+            newMat, _ = cv.getOptimalNewCameraMatrix(
+                mat, self.distCoeffs, (width, height), alpha, (width, height)
+            )
+            map1, map2 = cv.initUndistortRectifyMap(
+                mat, self.distCoeffs, None, newMat, (width, height), cv.CV_16SC2
+            )
+            maps = (map1, map2, newMat)
+            try:
+                os.makedirs(team4121cache, exist_ok=True)
+                tmp = path + ".tmp.npz"
+                np.savez(tmp, map1=map1, map2=map2, matrix=newMat)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+        self.maps[key] = maps
+        return maps
@@ -21,8 +21,11 @@ class SingleFrame(CameraBase):
         )
         self.frame.fill(255)
 
-    def read_frame_raw(self) -> (bool, np.ndarray):
-        return True, self.frame.copy()
+    def read_frame_raw(self, out: Optional[np.ndarray] = None) -> (bool, np.ndarray):
+        if out is None or out.shape != self.frame.shape:
+            return True, self.frame.copy()
+        np.copyto(out, self.frame)
+        return True, out
 
 
 CameraBase.types["FRAME"] = SingleFrame
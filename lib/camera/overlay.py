@@ -0,0 +1,168 @@
+import cv2 as cv
+import numpy as np
+from typing import *
+from vision.base import FoundObjects, missing_int
+
+# Box colors (BGR) for each vision library's objects, and for the labels and header
+default_colors = {"RING": (0, 0, 255), "APRIL": (255, 0, 255)}
+other_color = (255, 255, 255)
+label_color = (0, 255, 0)
+header_color = (255, 255, 255)
+
+# The corners of boxes given as (x0, y0, x1, y1), in drawing order
+box_corners = np.array((0, 1, 2, 1, 2, 3, 0, 3))
+
+
+# Text drawn from strips rendered once with `cv.putText`, so drawing a label that's been drawn before is
+# one masked copy (cheaper than `cv.putText`, and much cheaper than composing it glyph by glyph in Python)
+# Making a strip costs a few `cv.putText`s, and labels change as values do, so text is drawn directly the
+# first time it's seen and only gets a strip if it comes up again. Only the last `size` or so are kept
+class GlyphStrips:
+    def __init__(
+        self,
+        color: Tuple[int, int, int],
+        font: int = cv.FONT_HERSHEY_SIMPLEX,
+        scale: float = 0.3,
+        thickness: int = 1,
+        size: int = 256,
+    ):
+        self.color = color
+        self.font = font
+        self.scale = scale
+        self.thickness = thickness
+        self.size = size
+        (_, self.ascent), descent = cv.getTextSize(
+            "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ", font, scale, thickness
+        )
+        self.height = self.ascent + descent + thickness
+        self.strips = {}
+        self.seen = set()
+
+    # Get the strip for some text as (image, mask)
+    def strip(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        entry = self.strips.get(text)
+        if entry is None:
+            if len(self.strips) >= self.size:
+                self.strips.clear()
+            (width, _), _ = cv.getTextSize(text, self.font, self.scale, self.thickness)
+            strip = np.zeros((self.height, max(width, 1), 3), dtype=np.uint8)
+            self.put_text(strip, text, (0, self.ascent))
+            mask = np.any(strip, axis=2).view(np.uint8)
+            entry = self.strips[text] = (strip, mask)
+        return entry
+
+    def put_text(self, img: np.ndarray, text: str, org: Tuple[int, int]):
+        cv.putText(
+            img,
+            text,
+            org,
+            self.font,
+            self.scale,
+            self.color,
+            self.thickness,
+            cv.LINE_8,
+        )
+
+    # Draw text with its baseline's left end at `org`, like `cv.putText`
+    def draw(self, img: np.ndarray, text: str, org: Tuple[int, int]):
+        if text not in self.strips and text not in self.seen:
+            if len(self.seen) >= self.size:
+                self.seen.clear()
+            self.seen.add(text)
+            self.put_text(img, text, org)
+            return
+        strip, mask = self.strip(text)
+        x, y = org[0], org[1] - self.ascent
+        h, w = mask.shape
+        if x >= 0 and y >= 0 and x + w <= img.shape[1] and y + h <= img.shape[0]:
+            cv.copyTo(strip, mask, img[y : y + h, x : x + w])
+            return
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, img.shape[1]), min(y + h, img.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        cv.copyTo(
+            strip[y0 - y : y1 - y, x0 - x : x1 - x],
+            mask[y0 - y : y1 - y, x0 - x : x1 - x],
+            img[y0:y1, x0:x1],
+        )
+
+
+# Draws found objects onto a frame: a box around each one, and its distance, angle, offset (and id, for
+# tags) next to it
+# `scale` is how much smaller the frame is than the camera's (object positions are in camera pixels)
+# All of a library's boxes are drawn with one `cv.polylines` call, and labels are drawn from `GlyphStrips`
+class OverlayRenderer:
+    def __init__(
+        self,
+        scale: int = 1,
+        colors: Dict[str, Tuple[int, int, int]] = default_colors,
+        labels: bool = True,
+    ):
+        self.scale = scale
+        self.colors = colors
+        self.labels = labels
+        self.thickness = 2 if scale == 1 else 1
+        self.glyphs = GlyphStrips(label_color, scale=0.3)
+        self.lineHeight = self.glyphs.height + 3
+        self.indent = max(10 // scale, 2)
+
+    # Draw `results` (library name: found objects) and an optional line of text at the top onto `img`, in
+    # place
+    def draw(
+        self, img: np.ndarray, results: Dict[str, Any], header: Optional[str] = None
+    ) -> np.ndarray:
+        for name, objs in results.items():
+            records = FoundObjects.of(objs).records
+            if len(records) == 0:
+                continue
+            boxes = np.empty((len(records), 4), dtype=np.int32)
+            boxes[:, 0] = records["x"]
+            boxes[:, 1] = records["y"]
+            boxes[:, 2] = records["w"]
+            boxes[:, 3] = records["h"]
+            # Anything without a box can't be drawn
+            if (boxes == missing_int).any():
+                keep = (boxes != missing_int).all(axis=1)
+                boxes = boxes[keep]
+                records = records[keep]
+                if len(records) == 0:
+                    continue
+            boxes[:, 2:] += boxes[:, :2]
+            if self.scale != 1:
+                boxes //= self.scale
+            cv.polylines(
+                img,
+                boxes[:, box_corners].reshape(-1, 4, 2),
+                True,
+                self.colors.get(name, other_color),
+                self.thickness,
+            )
+            if self.labels:
+                self.draw_labels(img, records, boxes[:, 0], boxes[:, 1])
+        # The header changes every frame, so there's nothing to gain from caching it
+        if header is not None:
+            cv.putText(
+                img, header, (0, 15), cv.FONT_HERSHEY_SIMPLEX, 0.5, header_color, 1
+            )
+        return img
+
+    def draw_labels(self, img: np.ndarray, records: np.ndarray, xs, ys):
+        glyphs = self.glyphs
+        for x, y, distance, angle, offset, ident in zip(
+            (xs + self.indent).tolist(),
+            ys.tolist(),
+            records["distance"].tolist(),
+            records["angle"].tolist(),
+            records["offset"].tolist(),
+            records["ident"].tolist(),
+        ):
+            y += self.lineHeight
+            glyphs.draw(img, "D: {:6.2f}".format(distance), (x, y))
+            y += self.lineHeight
+            glyphs.draw(img, "A: {:6.2f}".format(angle), (x, y))
+            y += self.lineHeight
+            glyphs.draw(img, "O: {:6.2f}".format(offset), (x, y))
+            if ident != missing_int:
+                y += self.lineHeight
+                glyphs.draw(img, "I: {}".format(ident), (x, y))
@@ -3,6 +3,7 @@ from typing import *
 from picamera2 import Picamera2
 import numpy as np
 import cv2 as cv
+import time
 
 # NOTE: the `picamera` library doesn't work on 64-bit targets, despite it being recommended in all of the RPi docs
 # `picamera2` is used instead (installed from pip)
@@ -12,6 +13,8 @@ Picamera2.set_logging(Picamera2.WARNING)
 
 # Use a picam
 class PiCam(CameraBase):
+    threadedCapture = True
+
     def __init__(
         self, name: str, timestamp: str, params: CameraParams = CameraParams()
     ):
@@ -22,9 +25,11 @@ class PiCam(CameraBase):
         self.camStream.brightness = float(self.get_config("BRIGHTNESS", 50))
         self.camStream.start()
 
-    def read_frame_raw(self) -> (bool, np.ndarray):
-        self.frame = cv.cvtColor(self.camStream.capture_array(), cv.COLOR_BGR2RGB)
-        return True, self.frame
+    def read_frame_raw(self, out: Optional[np.ndarray] = None) -> (bool, np.ndarray):
+        raw = self.camStream.capture_array()
+        self.captureTime = time.monotonic()
+        frame = cv.cvtColor(raw, cv.COLOR_BGR2RGB, dst=out)
+        return True, frame
 
 
 CameraBase.types["PI"] = PiCam
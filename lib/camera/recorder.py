@@ -0,0 +1,103 @@
+import threading
+import cv2 as cv
+import numpy as np
+from collections import deque
+from typing import *
+from threads import KillableThread, StopToken
+
+# What to do with a frame when the recorder's queue is full
+DROP_OLDEST = "OLDEST"  # throw away the oldest queued frame to make room
+DROP_NEWEST = "NEWEST"  # throw away the frame being submitted
+EVERY_NTH = "EVERY"  # only record every Nth frame, and drop the newest when full
+
+policies = (DROP_OLDEST, DROP_NEWEST, EVERY_NTH)
+
+
+# Writes frames to a video on a background thread, so encoding never holds up the vision loop
+# Frames are copied into a fixed pool of preallocated slots; when every slot is full, frames are dropped
+# according to the policy instead of blocking the caller
+class VideoRecorder:
+    def __init__(
+        self,
+        writer: cv.VideoWriter,
+        shape: Tuple[int, ...],
+        queueSize: int = 8,
+        policy: str = DROP_OLDEST,
+        every: int = 1,
+        log_file=None,
+        name: str = "recorder",
+    ):
+        if policy not in policies:
+            raise ValueError(f"unknown recording policy {policy}")
+        self.writer = writer
+        self.policy = policy
+        self.every = max(every, 1) if policy == EVERY_NTH else 1
+        self.log_file = log_file
+        self.slots = [np.zeros(shape, dtype=np.uint8) for _ in range(max(queueSize, 1))]
+        self.free = deque(range(len(self.slots)))
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.printException = True
+        self.thread = KillableThread(target=self._run, name=name, token=StopToken())
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a frame to be written. Never blocks on encoding
+    def write(self, img: np.ndarray):
+        self.submitted += 1
+        if (self.submitted - 1) % self.every != 0:
+            self.skipped += 1
+            return
+        with self.cond:
+            if len(self.free) > 0:
+                idx = self.free.popleft()
+            elif self.policy == DROP_OLDEST and len(self.queue) > 0:
+                idx = self.queue.popleft()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return
+        slot = self.slots[idx]
+        if slot.shape == img.shape:
+            np.copyto(slot, img)
+        else:
+            slot = self.slots[idx] = img.copy()
+        with self.cond:
+            self.queue.append(idx)
+            self.cond.notify()
+
+    def _run(self):
+        token = self.thread.token
+        while True:
+            with self.cond:
+                while len(self.queue) == 0 and not token.stopped:
+                    self.cond.wait()
+                if len(self.queue) == 0:
+                    break
+                idx = self.queue.popleft()
+            try:
+                self.writer.write(self.slots[idx])
+                self.written += 1
+            except Exception as write_error:
+                if self.printException and self.log_file is not None:
+                    self.printException = False
+                    self.log_file.write(
+                        "Error writing video:\n    type: {}\n    args: {}\n    {}\n".format(
+                            type(write_error), write_error.args, write_error
+                        )
+                    )
+            with self.cond:
+                self.free.append(idx)
+
+    # Finish writing everything that's queued, then release the writer
+    def close(self, timeout: float = 5.0):
+        with self.cond:
+            self.thread.kill()
+            self.cond.notify()
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.writer.release()
@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+from typing import *
+
+
+# Latest-frame ring buffer, shared between one capture thread and one vision thread
+# All of the frame buffers are allocated up front. The writer is never handed the newest slot or the
+# slot the reader is holding, so with at least three slots neither side has to take a lock; the reader
+# always gets the newest frame, and anything older that it never got to is counted as dropped
+class FrameRing:
+    def __init__(self, shape: Tuple[int, ...], dtype=np.uint8, size: int = 3):
+        if size < 3:
+            raise ValueError("a frame ring needs at least 3 slots")
+        self.size = size
+        self.buffers = [np.zeros(shape, dtype=dtype) for _ in range(size)]
+        self.stamps = [0.0] * size
+        self.seqs = [0] * size
+        self.seq = 0
+        self.latest = -1
+        self.reading = -1
+        self.writing = 0
+        self.dropped = 0
+        self.ready = threading.Event()
+
+    # Get the buffer the writer should fill next
+    def write_buffer(self) -> np.ndarray:
+        latest = self.latest
+        reading = self.reading
+        idx = self.writing
+        for _ in range(self.size):
+            idx = (idx + 1) % self.size
+            if idx != latest and idx != reading:
+                break
+        self.writing = idx
+        return self.buffers[idx]
+
+    # Swap in a different array for the buffer being written (e.g. the camera returned a new size)
+    def replace(self, frame: np.ndarray):
+        self.buffers[self.writing] = frame
+
+    # Publish the buffer last returned by `write_buffer`, captured at `stamp`
+    def publish(self, stamp: float):
+        idx = self.writing
+        self.seq += 1
+        self.seqs[idx] = self.seq
+        self.stamps[idx] = stamp
+        self.latest = idx
+        self.ready.set()
+
+    # Get the newest frame as (sequence number, capture time, frame), if it's newer than `after`
+    # The frame stays valid until the next call
+    def read(self, after: int) -> Optional[Tuple[int, float, np.ndarray]]:
+        while True:
+            idx = self.latest
+            if idx < 0 or self.seqs[idx] <= after:
+                return None
+            self.reading = idx
+            # If the writer published in between, it may already be filling this slot
+            if self.latest == idx:
+                break
+        seq = self.seqs[idx]
+        self.dropped += seq - after - 1
+        return seq, self.stamps[idx], self.buffers[idx]
+
+    # Like `read`, but wait up to `timeout` seconds for a new frame
+    def wait(
+        self, after: int, timeout: Optional[float] = None
+    ) -> Optional[Tuple[int, float, np.ndarray]]:
+        res = self.read(after)
+        if res is not None:
+            return res
+        self.ready.clear()
+        res = self.read(after)
+        if res is not None or not self.ready.wait(timeout):
+            return res
+        return self.read(after)
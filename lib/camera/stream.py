@@ -0,0 +1,129 @@
+import threading
+import time
+import cv2 as cv
+import numpy as np
+from typing import *
+from threads import KillableThread, StopToken
+
+
+# Streams frames to a cscore source on a background thread, so the vision loop only ever copies a frame
+# Nothing is done while no dashboard is watching (the source isn't enabled without a client), and frames
+# are only taken at up to `fps`. The newest frame taken replaces any the thread hasn't got to yet
+# Frames are shrunk by `scale` into buffers kept from frame to frame, halving them with `cv.pyrDown` when
+# the scale is a power of two that divides the size evenly and with `cv.INTER_AREA` otherwise
+# If there's an `overlay` (see `camera.overlay`), the results submitted with a frame are drawn onto the
+# shrunk copy, so the frame the vision libraries and recorder see is never touched
+class FrameStreamer:
+    def __init__(
+        self,
+        source,
+        shape: Tuple[int, ...],
+        scale: int = 1,
+        fps: float = 30.0,
+        overlay=None,
+        log_file=None,
+        name: str = "stream",
+    ):
+        self.source = source
+        self.overlay = overlay
+        self.log_file = log_file
+        h, w = shape[:2]
+        self.size = (w // scale, h // scale)
+        self.levels = 0
+        if scale > 1 and scale & (scale - 1) == 0 and w % scale == 0 and h % scale == 0:
+            self.levels = scale.bit_length() - 1
+        self.period = 1.0 / fps if fps > 0 else 0.0
+        self.next = 0.0
+        self.pending = np.zeros(shape, dtype=np.uint8)
+        self.working = np.zeros(shape, dtype=np.uint8)
+        self.pendingResults = None
+        self.buffers = {}
+        self.hasFrame = False
+        self.cond = threading.Condition()
+        self.submitted = 0
+        self.streamed = 0
+        self.printException = True
+        self.thread = KillableThread(target=self._run, name=name, token=StopToken())
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Whether any client is watching the stream
+    def watched(self) -> bool:
+        return self.source.isEnabled()
+
+    # Offer a frame, and the results found in it, to the stream. Returns right away if nobody's watching
+    # or it isn't time for a frame; otherwise the frame is copied, so the caller can reuse its buffer
+    # The results are kept as they are, so they mustn't be changed afterwards
+    def submit(self, img: np.ndarray, results: Optional[dict] = None):
+        now = time.monotonic()
+        if now < self.next or not self.watched():
+            return
+        self.next = now + self.period
+        self.submitted += 1
+        with self.cond:
+            if self.pending.shape == img.shape:
+                np.copyto(self.pending, img)
+            else:
+                self.pending = img.copy()
+            self.pendingResults = results
+            self.hasFrame = True
+            self.cond.notify()
+
+    # Get the preallocated buffer for a shrunk frame
+    def buffer(self, key, shape: Tuple[int, ...]) -> np.ndarray:
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.uint8)
+            self.buffers[key] = buf
+        return buf
+
+    # Shrink a frame to the stream's size
+    def shrink(self, img: np.ndarray) -> np.ndarray:
+        w, h = self.size
+        if img.shape[1] == w and img.shape[0] == h:
+            return img
+        if self.levels > 0 and img.shape[1] == w << self.levels:
+            for level in range(1, self.levels + 1):
+                sh, sw = img.shape[:2]
+                dst = self.buffer(level, ((sh + 1) // 2, (sw + 1) // 2, *img.shape[2:]))
+                img = cv.pyrDown(img, dst=dst)
+            return img
+        return cv.resize(
+            img,
+            (w, h),
+            dst=self.buffer("area", (h, w, *img.shape[2:])),
+            interpolation=cv.INTER_AREA,
+        )
+
+    def _run(self):
+        token = self.thread.token
+        while True:
+            with self.cond:
+                while not self.hasFrame and not token.stopped:
+                    self.cond.wait()
+                if token.stopped:
+                    break
+                self.pending, self.working = self.working, self.pending
+                results = self.pendingResults
+                self.pendingResults = None
+                self.hasFrame = False
+            try:
+                out = self.shrink(self.working)
+                if self.overlay is not None and results is not None:
+                    self.overlay.draw(out, results)
+                self.source.putFrame(out)
+                self.streamed += 1
+            except Exception as stream_error:
+                if self.printException and self.log_file is not None:
+                    self.printException = False
+                    self.log_file.write(
+                        "Error streaming video:\n    type: {}\n    args: {}\n    {}\n".format(
+                            type(stream_error), stream_error.args, stream_error
+                        )
+                    )
+
+    def close(self, timeout: float = 1.0):
+        with self.cond:
+            self.thread.kill()
+            self.cond.notify()
+        self.thread.join(timeout)
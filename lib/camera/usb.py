@@ -5,6 +5,7 @@ import cv2 as cv
 import numpy as np
 import subprocess
 import re
+import time
 
 
 # How does this work? I have no idea!
@@ -44,6 +45,8 @@ pi5_re = re.compile("platform-xhci-hcd_(\\d)-usb-0_(\\d)_1_0")
 
 # Camera using `cv.VideoCapture`, best for USB camera
 class UsbCamera(CameraBase):
+    threadedCapture = True
+
     def __init__(
         self, name: str, timestamp: str, params: CameraParams = CameraParams()
     ):
@@ -155,14 +158,21 @@ class UsbCamera(CameraBase):
             except cv.error as e:
                 self.log_file.write(f"Error during post-init: {e}\n")
 
-    def read_frame_raw(self) -> Tuple[bool, np.ndarray]:
+    def read_frame_raw(
+        self, out: Optional[np.ndarray] = None
+    ) -> Tuple[bool, np.ndarray]:
         if not self.evenTry:
             return False, np.zeros((0, 0, 3))
         if not self.camStream.isOpened():
             self.evenTry = False
             return False, np.zeros((0, 0, 3))
         try:
-            good, frame = self.camStream.read()
+            # Grab first, so the capture time doesn't include decoding
+            good = self.camStream.grab()
+            self.captureTime = time.monotonic()
+            if not good:
+                return False, np.zeros((0, 0, 3))
+            good, frame = self.camStream.retrieve(out)
         except cv.error as e:
             if self.printException:
                 self.printException = False
@@ -0,0 +1,231 @@
+from camera.base import *
+from camera.calib import team4121cache
+from typing import *
+import os
+import glob
+import hashlib
+import time
+import cv2 as cv
+import numpy as np
+
+# How fast to play a video back
+REALTIME = "REALTIME"  # at its frame rate, skipping frames when processing falls behind
+MAX = "MAX"  # every frame, as fast as they're processed
+STEP = "STEP"  # every frame, one every 1/STEP_FPS seconds (or later, if processing falls behind)
+
+playbacks = (REALTIME, MAX, STEP)
+
+
+# Play back a video (like the ones recorded into videos/) as if it were a camera
+# FILE is the video, relative to the videos directory, or the newest video there if it's not given
+# PLAYBACK is REALTIME, MAX or STEP (see above), and LOOP=1 starts over at the end. With MAX and STEP every
+# frame is read inline, so the frame ids of two runs line up frame for frame
+# PRELOAD=1 decodes the whole video once into a raw frame cache, which is memory-mapped on later runs, so
+# decoding doesn't count against the vision loop
+# WIDTH, HEIGHT and FPS default to the video's; frames of a different size are resized
+# STOP_AT_END=1 stops the camera when the video ends and calls `onEnd`, which `run/raspberrypi4.py` uses to
+# stop the whole program
+class VideoCamera(CameraBase):
+    def __init__(
+        self, name: str, timestamp: str, params: CameraParams = CameraParams()
+    ):
+        self.name = name
+        self.videoProps = {}
+        file = params.devname
+        if file is None:
+            file = self.get_config("FILE", None)
+        if file is None:
+            videos = sorted(glob.glob(team4121videos + "/*.avi"), key=os.path.getmtime)
+            file = videos[-1] if len(videos) > 0 else None
+        elif not os.path.isabs(file):
+            file = os.path.join(team4121videos, file)
+        self.file = file
+        self.playback = self.get_config("PLAYBACK", REALTIME).upper()
+        if self.playback not in playbacks:
+            raise ValueError(f"unknown playback {self.playback}")
+
+        self.video = None
+        self.frameCount = 0
+        self.videoFps = 0.0
+        if file is not None:
+            self.video = cv.VideoCapture(file)
+            if self.video.isOpened():
+                self.frameCount = int(self.video.get(cv.CAP_PROP_FRAME_COUNT))
+                self.videoFps = self.video.get(cv.CAP_PROP_FPS)
+                self.videoProps = {
+                    "WIDTH": str(int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))),
+                    "HEIGHT": str(int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))),
+                }
+                if self.videoFps > 0:
+                    self.videoProps["FPS"] = str(round(self.videoFps))
+
+        # Reading ahead on a capture thread drops frames, which only a real-time camera should do
+        self.threadedCapture = self.playback == REALTIME
+
+        super().__init__(name, timestamp, params)
+
+        if self.video is None or not self.video.isOpened():
+            self.log_file.write(f"Can't open video {file}\n")
+            self.video = None
+        else:
+            self.log_file.write(
+                "Playing {} ({} frames at {:.1f} FPS, {})\n".format(
+                    file, self.frameCount, self.videoFps, self.playback
+                )
+            )
+        if self.videoFps <= 0:
+            self.videoFps = float(self.fps)
+        self.stepFps = float(self.get_config("STEP_FPS", self.videoFps))
+        self.loop = int(self.get_config("LOOP", 0)) != 0
+        self.stopAtEnd = int(self.get_config("STOP_AT_END", 0)) != 0
+        self.position = 0
+        self.cache = None
+        if self.video is not None and int(self.get_config("PRELOAD", 0)) != 0:
+            self.cache = self.load_cache()
+            self.frameCount = len(self.cache)
+        self.index = 0
+        self.start = None
+        self.ended = False
+
+    # The video's own size and frame rate are the defaults for this camera's
+    def get_config(self, name: str, default: str) -> str:
+        section = CameraBase.current_config().get(self.name, {})
+        if name in self.videoProps and name not in section:
+            return self.videoProps[name]
+        return super().get_config(name, default)
+
+    # Decode the next frame of the video, resized to this camera's size
+    def decode(self, out: Optional[np.ndarray] = None) -> Tuple[bool, np.ndarray]:
+        good, frame = self.video.read()
+        if not good:
+            return False, frame
+        self.position += 1
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            if out is None or out.shape != (self.height, self.width, 3):
+                out = None
+            frame = cv.resize(
+                frame, (self.width, self.height), dst=out, interpolation=cv.INTER_AREA
+            )
+        elif out is not None and out.shape == frame.shape:
+            np.copyto(out, frame)
+            frame = out
+        return True, frame
+
+    # Get the raw frame cache for the video, decoding it into one if there isn't one yet
+    # The cache is keyed by the video's path, size and modification time, and this camera's frame size
+    def load_cache(self) -> np.ndarray:
+        st = os.stat(self.file)
+        ident = "{}:{}:{}".format(os.path.abspath(self.file), st.st_size, st.st_mtime_ns)
+        key = hashlib.sha1(ident.encode()).hexdigest()[:16]
+        path = "{}/video_{}_{}x{}.raw".format(
+            team4121cache, key, self.width, self.height
+        )
+        frameSize = self.height * self.width * 3
+        if not os.path.exists(path):
+            os.makedirs(team4121cache, exist_ok=True)
+            tmp = path + ".tmp"
+            count = 0
+            with open(tmp, "wb") as out_file:
+                while True:
+                    good, frame = self.decode()
+                    if not good:
+                        break
+                    frame.tofile(out_file)
+                    count += 1
+            os.replace(tmp, path)
+            self.log_file.write(f"Cached {count} frames in {path}\n")
+        count = os.path.getsize(path) // frameSize
+        return np.memmap(
+            path, dtype=np.uint8, mode="r", shape=(count, self.height, self.width, 3)
+        )
+
+    # Wait until `due` (`time.monotonic()`), returning false if the camera was stopped first
+    # When frames are read inline, the wait isn't counted as capture time when profiling (on the capture
+    # thread, the timer belongs to the vision thread, which skips its own wait for the frame)
+    def wait_until(self, due: float) -> bool:
+        delay = due - time.monotonic()
+        if delay <= 0:
+            return True
+        stopped = self.stopToken.wait(delay)
+        if self.timer is not None and not self.threadedCapture:
+            self.timer.skip()
+        return not stopped
+
+    # Pick the next frame to play and wait until it's due
+    def next_index(self) -> Optional[int]:
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        index = self.index
+        if self.playback == REALTIME:
+            # Skip whatever we're too late for, like a camera would
+            index = max(index, int((now - self.start) * self.videoFps))
+            due = self.start + index / self.videoFps
+        elif self.playback == STEP:
+            due = self.start + index / self.stepFps
+        else:
+            due = now
+        if not self.wait_until(due):
+            return None
+        return index
+
+    # Seek the video to a frame, by decoding up to it if it's ahead
+    def seek(self, index: int):
+        if index < self.position:
+            self.video.set(cv.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+        while self.position < index and self.video.grab():
+            self.position += 1
+
+    def read_frame_raw(
+        self, out: Optional[np.ndarray] = None
+    ) -> Tuple[bool, np.ndarray]:
+        if self.video is None or self.ended:
+            return False, np.zeros((0, 0, 3))
+        index = self.next_index()
+        if index is None:
+            return False, np.zeros((0, 0, 3))
+        if index >= self.frameCount > 0 and self.loop:
+            index = 0
+            self.start = time.monotonic()
+        if self.cache is not None:
+            good = index < len(self.cache)
+            if good:
+                frame = self.cache[index]
+                if out is not None and out.shape == frame.shape:
+                    np.copyto(out, frame)
+                    frame = out
+                else:
+                    frame = np.array(frame)
+        else:
+            self.seek(index)
+            good, frame = self.decode(out)
+            if not good and self.loop and index > 0:
+                # The frame count was wrong, start over
+                self.frameCount = index
+                self.seek(0)
+                index = 0
+                self.start = time.monotonic()
+                good, frame = self.decode(out)
+        self.captureTime = time.monotonic()
+        if not good:
+            self.end(index)
+            return False, np.zeros((0, 0, 3))
+        self.index = index + 1
+        return True, frame
+
+    def end(self, index: int):
+        self.ended = True
+        self.log_file.write(f"End of video after {index} frames\n")
+        if self.stopAtEnd:
+            self.stopToken.stop()
+            if self.onEnd is not None:
+                self.onEnd()
+
+    def close(self):
+        super().close()
+        if self.video is not None:
+            self.video.release()
+
+
+CameraBase.types["VIDEO"] = VideoCamera
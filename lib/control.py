@@ -0,0 +1,82 @@
+import threading
+import ntcore
+from typing import *
+
+
+# Event-driven control of the vision program over NetworkTables
+# Whether NT is connected, cameras being enabled, and the robot's stop signal all come in through ntcore
+# listeners and are kept in plain attributes and a `threading.Event`, so nothing reads from NT per frame
+# The listeners run on ntcore's thread, which mustn't call back into ntcore, so they (and the callbacks
+# given to `watch`) only set flags
+class ControlPlane:
+    def __init__(self, inst: ntcore.NetworkTableInstance, log_file=None):
+        self.inst = inst
+        self.log_file = log_file
+        self.connected = inst.isConnected()
+        self.stopEvent = threading.Event()
+        self.stopRequested = False
+        self.listeners = [inst.addConnectionListener(True, self._connection)]
+
+    def _connection(self, event: ntcore.Event):
+        self.connected = event.is_(ntcore.EventFlags.kConnected)
+        self.log(
+            "Connected to NT server\n"
+            if self.connected
+            else "Disconnected from NT server\n"
+        )
+
+    # Call `callback` with the new value whenever `key` in `table` changes, and with its current value
+    # right away if it has one
+    def watch(
+        self,
+        table: ntcore.NetworkTable,
+        key: str,
+        callback: Callable[[ntcore.Value], Any],
+    ):
+        def changed(table, key, event):
+            callback(event.data.value)
+
+        self.listeners.append(
+            table.addListener(
+                key,
+                ntcore.EventFlags.kValueAll | ntcore.EventFlags.kImmediate,
+                changed,
+            )
+        )
+
+    # Stop once `key` in `table` is set to 1
+    def watch_stop(self, table: ntcore.NetworkTable, key: str):
+        def changed(value: ntcore.Value):
+            if value.value() == 1:
+                self.stop("Received stop signal from NT\n")
+
+        self.watch(table, key, changed)
+
+    # Tell everything waiting on this to stop. Not for signal handlers (see `request_stop`)
+    def stop(self, reason: Optional[str] = None):
+        if reason is not None:
+            self.log(reason)
+        self.stopEvent.set()
+
+    # Stop from a signal handler. Setting the event takes its lock, which the interrupted main thread may
+    # be holding in `wait`, so this only sets a flag, which waiters see when their timeout runs out
+    def request_stop(self):
+        self.stopRequested = True
+
+    @property
+    def stopped(self) -> bool:
+        return self.stopRequested or self.stopEvent.is_set()
+
+    # Wait up to `timeout` seconds to be stopped, returning whether we were
+    # Give a timeout if a stop may come from `request_stop`, since that doesn't wake the wait
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.stopEvent.wait(timeout) or self.stopRequested
+
+    def log(self, msg: str):
+        if self.log_file is not None:
+            self.log_file.write(msg)
+
+    def close(self):
+        for listener in self.listeners:
+            self.inst.removeListener(listener)
+        self.listeners = []
@@ -1,8 +1,145 @@
+import os
+import threading
+import time
+from collections import namedtuple
 from ctypes import CDLL
+from typing import *
+from threads import KillableThread, StopToken
 
 libc = CDLL("libc.so.6")
 
 
+# Flush and sync everything on the system. This can stall for a long time on an SD card, so it should
+# only be used at startup and shutdown; use `durability` for files written while running
 def flush():
     libc.fflush(None)
     libc.sync()
+
+
+DurabilityStats = namedtuple(
+    "DurabilityStats",
+    ("passes", "syncs", "overruns", "mean", "max", "last"),
+)
+
+
+# Keeps the files we own durable without stalling the threads writing them
+# Registered files are fsync'd one by one on a background thread every `interval` seconds. A pass stops
+# once it has used up `budget` seconds, and the next pass picks up where it left off
+# Only data that has reached the OS is synced, so writers should still `flush()` their Python buffers
+class DurabilityService:
+    def __init__(self, interval: float = 1.0, budget: float = 0.25):
+        self.interval = interval
+        self.budget = budget
+        self.files = {}
+        self.lock = threading.Lock()
+        self.next = 0
+        self.thread = None
+        self.passes = 0
+        self.syncs = 0
+        self.overruns = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.lastTime = 0.0
+
+    # Register a file object or a path to keep synced. Paths are opened read-only when they're synced,
+    # which is how files owned by something else (e.g. a `cv.VideoWriter`) are handled
+    def register(self, file: Union[str, IO]):
+        with self.lock:
+            self.files[self._key(file)] = [file, None]
+        if self.thread is None:
+            self.start()
+
+    def unregister(self, file: Union[str, IO]):
+        with self.lock:
+            entry = self.files.pop(self._key(file), None)
+        if entry is not None and entry[1] is not None:
+            os.close(entry[1])
+
+    def start(self):
+        self.thread = KillableThread(
+            target=self._run, name="durability", token=StopToken()
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        if self.thread is not None:
+            self.thread.kill()
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        token = self.thread.token
+        while not token.wait(self.interval):
+            self.sync_pass()
+
+    # Paths are keyed by where they point, so any equal path unregisters them; file objects by identity
+    @staticmethod
+    def _key(file: Union[str, IO]):
+        return os.path.abspath(file) if type(file) is str else id(file)
+
+    def _fd(self, entry) -> Optional[int]:
+        file = entry[0]
+        if type(file) is str:
+            if entry[1] is None:
+                try:
+                    fd = os.open(file, os.O_RDONLY)
+                except OSError:
+                    return None
+                with self.lock:
+                    # Unregistered while it was being opened, so nothing else will close it
+                    if self.files.get(self._key(file)) is not entry:
+                        os.close(fd)
+                        return None
+                    entry[1] = fd
+            return entry[1]
+        # The owner may close it on another thread at any point
+        try:
+            if file.closed:
+                return None
+            return file.fileno()
+        except (ValueError, OSError):
+            return None
+
+    # Sync as many registered files as fit in the time budget
+    def sync_pass(self):
+        with self.lock:
+            entries = list(self.files.values())
+        if len(entries) == 0:
+            return
+        start = time.monotonic()
+        count = len(entries)
+        for n in range(count):
+            entry = entries[(self.next + n) % count]
+            fd = self._fd(entry)
+            if fd is None:
+                continue
+            t0 = time.monotonic()
+            try:
+                os.fsync(fd)
+            except OSError:
+                continue
+            t1 = time.monotonic()
+            self.syncs += 1
+            self.lastTime = t1 - t0
+            self.totalTime += self.lastTime
+            self.maxTime = max(self.maxTime, self.lastTime)
+            if t1 - start > self.budget and n + 1 < count:
+                self.overruns += 1
+                self.next = (self.next + n + 1) % count
+                break
+        self.passes += 1
+
+    # Latency of the fsyncs done so far, in seconds
+    def stats(self) -> DurabilityStats:
+        return DurabilityStats(
+            self.passes,
+            self.syncs,
+            self.overruns,
+            self.totalTime / self.syncs if self.syncs > 0 else 0.0,
+            self.maxTime,
+            self.lastTime,
+        )
+
+
+durability = DurabilityService()
@@ -0,0 +1,148 @@
+import os
+from typing import *
+from threads import KillableThread, StopToken
+
+
+# Parse a settings file (CameraSettings.txt, VisionSettings.txt) into a dict of sections, each a dict of
+# upper-cased keys to string values
+# "NAME:" lines start a section, "#" lines are comments, and keys before any section (or after a line
+# starting with "=") go in the "" section
+# Returns None if the file doesn't exist
+def parse_settings(file: str) -> Optional[Dict[str, Dict[str, str]]]:
+    config = {"": {}}
+    value_section = ""
+    try:
+        with open(file, "r") as in_file:
+            value_list = in_file.readlines()
+    except FileNotFoundError:
+        return None
+
+    for line in value_list:
+        # Remove trailing newlines and whitespace
+        clean_line = line.strip()
+        if len(clean_line) == 0:
+            continue
+        if clean_line[0] == "#":
+            continue
+        # Split the line into parts
+        split_line = clean_line.split("=")
+        # Determine section of the file we are in
+        upper_line = split_line[0].upper()
+
+        if upper_line[-1] == ":":
+            value_section = upper_line[:-1]
+            if not value_section in config:
+                config[value_section] = {}
+        elif split_line[0] == "":
+            value_section = ""
+        else:
+            config[value_section][split_line[0].upper()] = split_line[1]
+
+    return config
+
+
+# Write the values of one section back into a settings file, leaving everything else in it as it was
+# Keys already in the section are changed where they are, and new ones are added at the end of the section
+# (or a new section at the end of the file). The file is replaced in one go, so readers never see half of it
+def write_settings(file: str, section: str, values: Dict[str, str]):
+    try:
+        with open(file, "r") as in_file:
+            lines = in_file.readlines()
+    except FileNotFoundError:
+        lines = []
+    remaining = {key.upper(): val for key, val in values.items()}
+    value_section = ""
+    found = section == ""
+    last = 0 if section == "" else None
+
+    for i, line in enumerate(lines):
+        clean_line = line.strip()
+        if len(clean_line) == 0 or clean_line[0] == "#":
+            continue
+        split_line = clean_line.split("=")
+        upper_line = split_line[0].upper()
+        if upper_line[-1] == ":" or split_line[0] == "":
+            value_section = upper_line[:-1] if upper_line[-1] == ":" else ""
+            if value_section == section:
+                found = True
+                last = i + 1
+            continue
+        if value_section != section:
+            continue
+        last = i + 1
+        if upper_line in remaining:
+            lines[i] = "{}={}\n".format(split_line[0], remaining.pop(upper_line))
+
+    added = ["{}={}\n".format(key, val) for key, val in remaining.items()]
+    if not found:
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        lines += ["\n", section + ":\n", *added]
+    else:
+        lines[last:last] = added
+
+    tmp = file + ".tmp"
+    with open(tmp, "w") as out_file:
+        out_file.writelines(lines)
+    os.replace(tmp, file)
+
+
+# Watches settings files and calls back when one changes, so they can be reloaded without a restart
+# Files are polled for a new modification time or size every `interval` seconds on a background thread,
+# which also runs the callbacks; whatever they swap in is picked up by the vision loops between frames
+class SettingsWatcher:
+    def __init__(self, interval: float = 1.0, log_file=None):
+        self.interval = interval
+        self.log_file = log_file
+        self.files = {}
+        self.thread = None
+        self.reloads = 0
+
+    # Call `callback` whenever `file` changes
+    def watch(self, file: str, callback: Callable[[], Any]):
+        self.files[file] = [self._stamp(file), callback]
+
+    def _stamp(self, file: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    # Check every file once, calling back for the ones that changed
+    def poll(self):
+        for file, entry in self.files.items():
+            stamp = self._stamp(file)
+            if stamp is None or stamp == entry[0]:
+                continue
+            entry[0] = stamp
+            try:
+                entry[1]()
+                self.reloads += 1
+                if self.log_file is not None:
+                    self.log_file.write(f"Reloaded {file}\n")
+            except Exception as e:
+                if self.log_file is not None:
+                    self.log_file.write(
+                        "Error reloading {}, keeping the old settings:\n    {}\n".format(
+                            file, e
+                        )
+                    )
+
+    def start(self):
+        self.thread = KillableThread(
+            target=self._run, name="settings", token=StopToken()
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        if self.thread is not None:
+            self.thread.kill()
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        token = self.thread.token
+        while not token.wait(self.interval):
+            self.poll()
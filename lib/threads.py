@@ -1,5 +1,4 @@
 import threading
-import sys
 from typing import *
 
 tls = threading.local()
@@ -14,7 +13,27 @@ def get_tls(name: str, init):
     return var
 
 
+# Cooperative cancellation token. Loops check `stopped` between iterations (and use `wait` instead of
+# `time.sleep`), so stopping costs nothing until it's actually requested
+class StopToken:
+    def __init__(self):
+        self.event = threading.Event()
+
+    @property
+    def stopped(self) -> bool:
+        return self.event.is_set()
+
+    def stop(self):
+        self.event.set()
+
+    # Sleep for up to `timeout` seconds, waking early if stopped. Returns whether we've been stopped
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.event.wait(timeout)
+
+
 # Killable thread. Works like a normal Thread, but can be externally killed
+# Killing is cooperative: `kill` stops the thread's token, and the target is expected to check it
+# Pass `token` to share one token between several threads (e.g. everything belonging to a camera)
 class KillableThread(threading.Thread):
     def __init__(
         self,
@@ -24,34 +43,17 @@ class KillableThread(threading.Thread):
         args: Iterable = (),
         kwargs: Mapping[str, Any] = {},
         *,
-        daemon: Optional[bool] = None
+        daemon: Optional[bool] = None,
+        token: Optional[StopToken] = None
     ):
         threading.Thread.__init__(
             self, group, target, name, args, kwargs, daemon=daemon
         )
-        self.killed = False
-
-    def start(self):
-        self.__run_backup = self.run
-        self.run = self.__run
-        threading.Thread.start(self)
-
-    def __run(self):
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
-
-    def globaltrace(self, frame, event, arg):
-        if event == "call":
-            return self.localtrace
-        else:
-            return None
-
-    def localtrace(self, frame, event, arg):
-        if self.killed:
-            if event == "line":
-                raise SystemExit()
-        return self.localtrace
+        self.token = token if token is not None else StopToken()
+
+    @property
+    def killed(self) -> bool:
+        return self.token.stopped
 
     def kill(self):
-        self.killed = True
+        self.token.stop()
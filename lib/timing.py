@@ -0,0 +1,91 @@
+import time
+import numpy as np
+from typing import *
+
+perf_counter = time.perf_counter
+
+percentiles = (50, 95, 99)
+
+
+# Per-frame stage timer, for profiling a vision loop
+# Call `start` at the beginning of a frame, `lap` at the end of each stage, and `end` when the frame is
+# done. Stage durations go into a preallocated ring with one row per frame, and every `dumpEvery` frames
+# the p50/p95/p99 of each stage (in ms) are appended to a CSV file and handed to `publish`
+class StageTimer:
+    def __init__(
+        self,
+        stages: Sequence[str],
+        size: int = 512,
+        path: Optional[str] = None,
+        dumpEvery: int = 300,
+        publish: Optional[Callable[[Dict[str, Tuple[float, ...]]], None]] = None,
+    ):
+        self.stages = list(stages)
+        self.index = {stage: i for i, stage in enumerate(self.stages)}
+        self.size = size
+        self.times = np.zeros((size, len(self.stages)), dtype=np.float64)
+        self.frames = 0
+        self.dumped = 0
+        self.current = self.times[0]
+        self.last = perf_counter()
+        self.dumpEvery = dumpEvery
+        self.publish = publish
+        self.file = None
+        if path is not None:
+            self.file = open(path, "w")
+            self.file.write("frames,stage,p50_ms,p95_ms,p99_ms,mean_ms\n")
+
+    def start(self):
+        self.current.fill(0.0)
+        self.last = perf_counter()
+
+    # Add the time since the last lap to a stage (by index, see `index`)
+    def lap(self, stage: int):
+        now = perf_counter()
+        self.current[stage] += now - self.last
+        self.last = now
+
+    # Skip time that shouldn't count towards any stage
+    def skip(self):
+        self.last = perf_counter()
+
+    def end(self):
+        self.frames += 1
+        self.current = self.times[self.frames % self.size]
+        if self.dumpEvery > 0 and self.frames % self.dumpEvery == 0:
+            self.dump()
+
+    # Get the percentiles of each stage over the frames in the ring, in ms
+    def stats(self) -> Dict[str, Tuple[float, ...]]:
+        n = min(self.frames, self.size)
+        if n == 0:
+            return {}
+        times = self.times[:n] if n < self.size else self.times
+        pcts = np.percentile(times, percentiles, axis=0) * 1000
+        means = np.mean(times, axis=0) * 1000
+        return {
+            stage: (*map(float, pcts[:, i]), float(means[i]))
+            for i, stage in enumerate(self.stages)
+        }
+
+    def dump(self):
+        self.dumped = self.frames
+        stats = self.stats()
+        if self.file is not None:
+            for stage, vals in stats.items():
+                self.file.write(
+                    "{},{},{}\n".format(
+                        self.frames, stage, ",".join("{:.3f}".format(v) for v in vals)
+                    )
+                )
+            self.file.flush()
+        if self.publish is not None:
+            self.publish(stats)
+
+    # Dump the frames since the last dump, if any, so short runs still get their stats
+    def close(self):
+        if self.frames > self.dumped:
+            self.dump()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,5 +1,7 @@
 from vision.base import *
 from threads import get_tls
+import functools
+from collections import namedtuple
 import pyapriltags
 
 corners = np.array(
@@ -7,59 +9,117 @@ corners = np.array(
 )
 
 
-def cvt_res(
-    r: pyapriltags.Detection, cameraWidth: int, cameraHeight: int, cameraFOV: float
-) -> FoundObject:
+# Pinhole camera matrix estimated from the FOV, shared by every detection at the same resolution and FOV
+@functools.lru_cache(maxsize=16)
+def fov_intrinsics(cameraWidth: int, cameraHeight: int, cameraFOV: float) -> np.ndarray:
     f = 0.5 / math.tan(cameraFOV * math.pi / 360) * cameraWidth
-    camMat = np.array([[f, 0, cameraWidth // 2], [0, f, cameraHeight // 2], [0, 0, 1]])
-    xs = sorted([c[0] for c in r.corners])
-    ys = sorted([c[1] for c in r.corners])
-    w = int(xs[-1] - xs[0])
-    h = int(ys[-1] - ys[0])
-    x = int(r.center[0] - w // 2)
-    y = int(r.center[1] - h // 2)
-
-    obj = populate_obj(
-        FoundObject(
-            "TAG",
-            x,
-            y,
-            w=w,
-            h=h,
-            ident=r.tag_id,
-        ),
-        6.5,
-        cameraWidth,
-        cameraHeight,
-        cameraFOV,
+    camMat = np.array(
+        [[f, 0, cameraWidth // 2], [0, f, cameraHeight // 2], [0, 0, 1]],
+        dtype=np.float64,
     )
+    camMat.flags.writeable = False
+    return camMat
 
-    good, _, pose_t = cv.solvePnP(
-        corners, r.corners, camMat, None, flags=cv.SOLVEPNP_IPPE_SQUARE
-    )
 
-    if good:
-        dist = math.sqrt(np.sum(np.square(pose_t)))
-        # dist = 1.16 * dist - 3.5
-        obj.distance = dist
-    return obj
+# Convert every detection in a frame at once
+# `origin` is where the image the tags were found in is in the full frame
+# If a calibrated camera matrix is given, it's used for the pose instead of one estimated from the FOV,
+# and with distortion coefficients, only the tags' corners are undistorted (rather than the whole frame)
+def cvt_results(
+    results: Sequence[pyapriltags.Detection],
+    cameraWidth: int,
+    cameraHeight: int,
+    cameraFOV: float,
+    origin: Tuple[int, int] = (0, 0),
+    camMat: Optional[np.ndarray] = None,
+    distCoeffs: Optional[np.ndarray] = None,
+) -> FoundObjects:
+    n = len(results)
+    if n == 0:
+        return FoundObjects("TAG")
+
+    # Four corners and the center of each tag
+    points = np.empty((n, 5, 2), dtype=np.float64)
+    for i, r in enumerate(results):
+        points[i, :4] = r.corners
+        points[i, 4] = r.center
+    if origin != (0, 0):
+        points += origin
+    if camMat is None:
+        camMat = fov_intrinsics(cameraWidth, cameraHeight, cameraFOV)
+    elif distCoeffs is not None:
+        points = cv.undistortPoints(
+            points.reshape(-1, 1, 2), camMat, distCoeffs, P=camMat
+        ).reshape(n, 5, 2)
+
+    # Bounding boxes, centered on the tag centers
+    quads = points[:, :4]
+    sizes = (quads.max(axis=1) - quads.min(axis=1)).astype(np.int32)
+    locs = (points[:, 4] - sizes // 2).astype(np.int32)
+
+    # One record per tag, with the fields in `object_fields` order
+    rows = []
+    for i, (r, (x, y), (w, h)) in enumerate(
+        zip(results, locs.tolist(), sizes.tolist())
+    ):
+        distance, angle, offset = object_metrics(x, w, 6.5, cameraWidth, cameraFOV)
+
+        good, _, pose_t = cv.solvePnP(
+            corners, points[i, :4], camMat, None, flags=cv.SOLVEPNP_IPPE_SQUARE
+        )
+
+        if good:
+            distance = math.hypot(*pose_t.ravel())
+            # distance = 1.16 * distance - 3.5
+        rows.append(
+            (x, y, w, h, math.nan, distance, angle, offset, math.nan, r.tag_id)
+        )
+    return FoundObjects("TAG", np.array(rows, dtype=object_dtype))
+
+
+# Convert a single detection
+def cvt_res(
+    r: pyapriltags.Detection,
+    cameraWidth: int,
+    cameraHeight: int,
+    cameraFOV: float,
+    origin: Tuple[int, int] = (0, 0),
+    camMat: Optional[np.ndarray] = None,
+    distCoeffs: Optional[np.ndarray] = None,
+) -> FoundObject:
+    return cvt_results(
+        (r,), cameraWidth, cameraHeight, cameraFOV, origin, camMat, distCoeffs
+    )[0]
+
+
+# Settings of the AprilTag library
+AprilTagParams = namedtuple("AprilTagParams", ("calibrated",))
 
 
 class AprilTagVisionLibrary(VisionBase):
     # Define class initialization
     def __init__(self):
-        super()
+        super().__init__()
         self.name = "APRIL"
+        self.reload()
+
+    def compile_params(self) -> AprilTagParams:
+        return AprilTagParams(calibrated=self.cfg("CALIBRATED", 0, int, False) != 0)
 
     # Locates the cubes and cones in the game (2023)
     # returns a tuple containing (cubes, cones)
     def find_objects(
         self, imgRaw: np.ndarray, cameraWidth: int, cameraHeight: int, cameraFOV: int
-    ) -> List[FoundObject]:
+    ) -> FoundObjects:
         detector = get_tls(
             "at_detect", lambda: pyapriltags.Detector(families="tag36h11")
         )
-        gray = cv.cvtColor(imgRaw, cv.COLOR_BGR2GRAY)
+        images = frame_images(imgRaw)
+        gray = images.gray()
+        if self.params.calibrated:
+            camMat, distCoeffs = images.camMatrix, images.distCoeffs
+        else:
+            camMat, distCoeffs = None, None
         results = detector.detect(
             gray,
             # estimate_tag_pose=True,
@@ -67,4 +127,12 @@ class AprilTagVisionLibrary(VisionBase):
             # tag_size=6.5,
         )
 
-        return [cvt_res(r, cameraWidth, cameraHeight, cameraFOV) for r in results]
+        return cvt_results(
+            results,
+            cameraWidth,
+            cameraHeight,
+            cameraFOV,
+            images.origin,
+            camMat,
+            distCoeffs,
+        )
@@ -16,11 +16,38 @@
 import cv2 as cv
 import numpy as np
 import math
-from threading import Thread
+import threading
+from threads import KillableThread, StopToken
+from settings import parse_settings
+from vision.images import (
+    FrameImages,
+    frame_images,
+    BlurSpec,
+    blur_spec,
+    default_blur,
+)
 from typing import *
 
 
+# Structuring element for eroding and dilating masks
+kernel3 = np.ones((3, 3), np.uint8)
+
+
 class FoundObject:
+    __slots__ = (
+        "ty",
+        "x",
+        "y",
+        "w",
+        "h",
+        "radius",
+        "distance",
+        "angle",
+        "offset",
+        "percent",
+        "ident",
+    )
+
     # initialize FoundObject, with unused fields defaulting to None
     # ty, x, and y are mandatory
     # all other parameters must be named
@@ -70,12 +97,110 @@ class FoundObject:
         return out
 
 
+# The fields of a found object, as stored in a `FoundObjects` array
+# Missing values are NaN in the float fields and `missing_int` in the integer ones
+missing_int = np.iinfo(np.int32).min
+object_dtype = np.dtype(
+    [
+        ("x", np.int32),
+        ("y", np.int32),
+        ("w", np.int32),
+        ("h", np.int32),
+        ("radius", np.float64),
+        ("distance", np.float64),
+        ("angle", np.float64),
+        ("offset", np.float64),
+        ("percent", np.float64),
+        ("ident", np.int32),
+    ]
+)
+object_fields = object_dtype.names
+missing_record = np.array(
+    [
+        tuple(
+            missing_int if object_dtype[field].kind == "i" else np.nan
+            for field in object_fields
+        )
+    ],
+    dtype=object_dtype,
+)
+
+
+# Every object of one type found in a frame, stored in one structured array (`records`) instead of one
+# `FoundObject` per detection
+# Fields can be read as whole columns (`objs.distance`), and for code expecting a list of `FoundObject`s,
+# iterating or indexing gives `FoundObject`s made from the records
+class FoundObjects:
+    __slots__ = ("ty", "records")
+
+    def __init__(self, ty, records: Optional[np.ndarray] = None, count: int = 0):
+        self.ty = ty
+        if records is None:
+            records = missing_record.repeat(count)
+        self.records = records
+
+    # Convert a list of `FoundObject`s (all of the same type), or pass through something that's converted
+    @staticmethod
+    def of(
+        objs: Union["FoundObjects", Sequence[FoundObject]], ty=None
+    ) -> "FoundObjects":
+        if isinstance(objs, FoundObjects):
+            return objs
+        if len(objs) > 0:
+            ty = objs[0].ty
+        found = FoundObjects(ty, count=len(objs))
+        for field in object_fields:
+            missing = missing_record[field].item()
+            values = [getattr(obj, field) for obj in objs]
+            found.records[field] = [missing if val is None else val for val in values]
+        return found
+
+    # A column with missing values replaced by `default`
+    def column(self, field: str, default: float = np.nan) -> np.ndarray:
+        col = self.records[field]
+        if col.dtype.kind == "i":
+            return np.where(col == missing_int, default, col)
+        return np.where(np.isnan(col), default, col)
+
+    def __getattr__(self, field: str) -> np.ndarray:
+        if field in object_fields:
+            return self.records[field]
+        raise AttributeError(field)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _object(self, values: tuple) -> FoundObject:
+        obj = FoundObject(self.ty, 0, 0)
+        for field, val in zip(object_fields, values):
+            if val == missing_int or val != val:
+                val = None
+            setattr(obj, field, val)
+        return obj
+
+    def __iter__(self) -> Iterator[FoundObject]:
+        return map(self._object, self.records.tolist())
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return FoundObjects(self.ty, self.records[idx])
+        return self._object(self.records[idx].tolist())
+
+    def __str__(self):
+        return "\n".join(map(str, self))
+
+
 # Define the class
 class VisionBase:
     # Define class fields
     config = {}
     warned = set()
     init = False
+    params = None
+    # Held while the config is being replaced (never by the vision loops, which only read it)
+    configLock = threading.RLock()
+    # A config being compiled by `swap_config`, which `cfg` reads on that thread instead of the current one
+    compiling = threading.local()
 
     # Class Initialization method
     # Reads the contents of the supplied vision settings file
@@ -85,54 +210,84 @@ class VisionBase:
         self.isFinished = 0
 
     # Read vision settings file
+    # With `reload`, the settings are read again and replace the old ones as a whole; to change them under
+    # running libraries, use `swap_config` instead
     @staticmethod
     def read_vision_file(file: str, reload: bool = False) -> bool:
         if VisionBase.init and not reload:
             return True
         VisionBase.init = True
-        # Declare local variables
-        value_section = ""
-        # Open the file and read contents
-        try:
-            # Open the file for reading
-            in_file = open(file, "r")
-
-            # Read in all lines
-            value_list = in_file.readlines()
-
-            # Process list of lines
-            for line in value_list:
-                # Remove trailing newlines and whitespace
-                clean_line = line.strip()
-                if len(clean_line) == 0:
-                    continue
-                if clean_line[0] == "#":
-                    continue
-                # Split the line into parts
-                split_line = clean_line.split("=")
-                # Determine section of the file we are in
-                upper_line = split_line[0].upper()
-
-                if upper_line[-1] == ":":
-                    value_section = upper_line[:-1]
-                    if not value_section in VisionBase.config:
-                        VisionBase.config[value_section] = {}
-                elif split_line[0] == "":
-                    value_section = ""
-                    if not value_section in VisionBase.config:
-                        VisionBase.config[value_section] = {}
-                else:
-                    VisionBase.config[value_section][split_line[0].upper()] = (
-                        split_line[1]
-                    )
-
-        except FileNotFoundError:
+        config = parse_settings(file)
+        if config is None:
             return False
-
+        with VisionBase.configLock:
+            VisionBase.config = config
         return True
 
+    # Replace the whole config, and recompile the parameters of `libs` with it
+    # Every library is compiled against the new config before anything is assigned, so if one of them
+    # fails, the error is raised and the old config and parameters all stay as they were
+    @staticmethod
+    def swap_config(
+        config: Dict[str, Dict[str, str]], libs: Sequence["VisionBase"] = ()
+    ):
+        with VisionBase.configLock:
+            VisionBase.compiling.config = config
+            try:
+                params = [lib.compile_params() for lib in libs]
+            finally:
+                VisionBase.compiling.config = None
+            VisionBase.config = config
+            for lib, p in zip(libs, params):
+                lib.params = p
+
+    # Change some of the settings in one section, and recompile the parameters of `libs` with them (see
+    # `swap_config`)
+    @staticmethod
+    def update_config(
+        section: str, values: Dict[str, str], libs: Sequence["VisionBase"] = ()
+    ):
+        with VisionBase.configLock:
+            config = dict(VisionBase.config)
+            config[section] = {**config.get(section, {}), **values}
+            VisionBase.swap_config(config, libs)
+
+    # Turn this library's settings into the parameters `find_objects` uses, so the settings are looked up
+    # and converted once instead of every frame
+    # Overridden by libraries with settings, which should return something immutable (e.g. a namedtuple)
+    def compile_params(self):
+        return None
+
+    # Recompile the parameters from the current settings
+    # They're swapped in with a single assignment, so a frame being processed meanwhile sees either the old
+    # or the new parameters, never a mix
+    def reload(self):
+        self.params = self.compile_params()
+        return self.params
+
+    # Read how this library blurs frames before thresholding (BLUR, BLUR_SIZE and BLUR_SCALE)
+    def cfg_blur(self) -> BlurSpec:
+        return blur_spec(
+            self.cfg("BLUR", "GAUSSIAN", str, False),
+            self.cfg("BLUR_SIZE", 13, int, False),
+            self.cfg("BLUR_SCALE", 1, int, False),
+        )
+
+    # Get a scratch buffer belonging to this library, kept between frames (one per name and shape)
+    def scratch(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        buffers = self.__dict__.setdefault("scratchBuffers", {})
+        key = (name, shape, dtype)
+        buf = buffers.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            buffers[key] = buf
+        return buf
+
     def cfg(self, name: str, default=None, datatype=str, warn: bool = True):
-        c = VisionBase.config[self.name]
+        config = getattr(VisionBase.compiling, "config", None)
+        if config is None:
+            config = VisionBase.config
+        c = config.get(self.name, {})
         if name in c:
             return datatype(c[name])
         else:
@@ -145,6 +300,8 @@ class VisionBase:
     # Converts image from BGR color space to HSV and then applies a mask
     # based on "learned" HSV values from the config file.
     # Edge detection can also be imployed before contours are found and returned.
+    # All of the intermediate images are written into this library's scratch buffers, so apart from the
+    # contours themselves, nothing large is allocated once the buffers exist
     def process_image_contours(
         self,
         imgRaw: np.ndarray,
@@ -152,34 +309,38 @@ class VisionBase:
         hsvMax: int,
         erodeDilate: bool,
         useCanny: bool,
-    ) -> List[Any]:
+        blur: BlurSpec = default_blur,
+    ) -> Sequence[np.ndarray]:
         finalImg = ""
 
-        # Blur image to remove noise
-        blur = cv.GaussianBlur(imgRaw, (13, 13), 0)
-        # blur = imgRaw
-
-        # Convert from BGR to HSV colorspace
-        hsv = cv.cvtColor(blur, cv.COLOR_BGR2HSV)
+        # Blur image to remove noise and convert from BGR to HSV colorspace
+        # These are shared with any other library looking at the same frame
+        images = frame_images(imgRaw)
+        hsv = images.hsv(blur)
+        shape = hsv.shape[:2]
 
         # Set pixels to white if in target HSV range, else set to black
-        mask = cv.inRange(hsv, hsvMin, hsvMax)
+        mask = cv.inRange(hsv, hsvMin, hsvMax, dst=self.scratch("mask", shape))
+        images.apply_mask(mask)
 
         # Detect edges
         if useCanny == True:
-            edges = cv.Canny(mask, 35, 125)
+            edges = cv.Canny(mask, 35, 125, edges=self.scratch("edges", shape))
         else:
             edges = mask
 
         if erodeDilate:
             # Erode image to reduce background noise
-            kernel = np.ones((3, 3), np.uint8)
-            erode = cv.erode(edges, kernel, iterations=2)
+            erode = cv.erode(
+                edges, kernel3, dst=self.scratch("erode", shape), iterations=2
+            )
 
             # cv.imshow('erode', erode)
 
             # Dilate image to sharpen actual objects
-            dilate = cv.dilate(erode, kernel, iterations=2)
+            dilate = cv.dilate(
+                erode, kernel3, dst=self.scratch("dilate", shape), iterations=2
+            )
 
             # cv.imshow('dilate', dilate)
 
@@ -193,7 +354,7 @@ class VisionBase:
             finalImg, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE
         )
 
-        return list(contours)
+        return contours
 
     def __str__(self):
         return getattr(self, "name", "<unnamed>")
@@ -218,17 +379,21 @@ class VisionBase:
 
     # Method for finding game objects
     # Generic method which will be overidden by child classes
+    # Returns either a `FoundObjects` or a list of `FoundObject`s
     def find_objects(
         self, imgRaw: np.ndarray, cameraWidth: int, cameraHeight: int, cameraFOV: int
-    ) -> List[FoundObject]:
+    ) -> Sequence[FoundObject]:
         return []
 
     # Update self, storing result. Not meant to be called directly
-    def _update(self, imgRaw, cameraWidth, cameraHeight, cameraFOV):
-        self.data = self.find_objects(imgRaw, cameraWidth, cameraHeight, cameraFOV)
-        self.isFinished = False
+    def _update(self, token, imgRaw, cameraWidth, cameraHeight, cameraFOV):
+        data = self.find_objects(imgRaw, cameraWidth, cameraHeight, cameraFOV)
+        if not token.stopped:
+            self.data = data
+            self.isFinished = False
 
     # Start running self in another thread
+    # If the token is stopped before the search finishes, the result is discarded
     def find_objects_threaded(
         self,
         imgRaw: np.ndarray,
@@ -236,16 +401,20 @@ class VisionBase:
         cameraHeight: int,
         cameraFOV: int,
         name: str = "findThread",
+        token: Optional[StopToken] = None,
     ):
         self.isFinished = True
+        if token is None:
+            token = StopToken()
 
-        calcThread = Thread(
+        self.calcThread = KillableThread(
             target=self._update,
             name=name,
-            args=(imgRaw, cameraWidth, cameraHeight, cameraFOV),
+            args=(token, imgRaw, cameraWidth, cameraHeight, cameraFOV),
+            token=token,
         )
-        calcThread.daemon = True
-        calcThread.start()
+        self.calcThread.daemon = True
+        self.calcThread.start()
 
         return self
 
@@ -257,13 +426,51 @@ def populate_obj(
     cameraHeight: int,
     cameraFOV: float,
 ) -> FoundObject:
+    obj.distance, obj.angle, obj.offset = object_metrics(
+        obj.x, obj.w, width, cameraWidth, cameraFOV
+    )
+    return obj
+
+
+# Below this many objects, calling `object_metrics` for each one is faster than `populate_metrics`
+metrics_batch_min = 10
+
+
+# Distance, angle and offset of an object `width` inches wide, at `x` and `w` pixels wide in the frame
+def object_metrics(
+    x: int, w: int, width: float, cameraWidth: int, cameraFOV: float
+) -> Tuple[float, float, float]:
     # Calculate metrics
-    inches_per_pixel = float(width) / obj.w  # set up a general conversion factor
+    inches_per_pixel = float(width) / w  # set up a general conversion factor
     distanceToTargetPlane = inches_per_pixel * (
         cameraWidth / (2 * math.tan(math.radians(cameraFOV / 2)))
     )
-    offsetInInches = inches_per_pixel * ((obj.x + (obj.w / 2)) - (cameraWidth / 2))
-    obj.angle = -math.degrees(math.atan((offsetInInches / distanceToTargetPlane)))
-    obj.distance = math.cos(math.radians(obj.angle)) * distanceToTargetPlane
-    obj.offset = -offsetInInches
-    return obj
+    offsetInInches = inches_per_pixel * ((x + (w / 2)) - (cameraWidth / 2))
+    angle = -math.degrees(math.atan((offsetInInches / distanceToTargetPlane)))
+    distance = math.cos(math.radians(angle)) * distanceToTargetPlane
+    return distance, angle, -offsetInInches
+
+
+# Vectorised version of `object_metrics` for every object found in a frame at once
+# Takes the x and width (in pixels) of each object and returns arrays of their distance, angle and offset
+# Numpy's per-call overhead means it's only faster from about `metrics_batch_min` objects up
+def populate_metrics(
+    x: np.ndarray,
+    w: np.ndarray,
+    width: float,
+    cameraWidth: int,
+    cameraFOV: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    x = np.asarray(x, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+    # Same as `populate_obj`, but the pixels-to-inches factor cancels out of the angle
+    focal = cameraWidth / (2 * math.tan(math.radians(cameraFOV / 2)))
+    inches_per_pixel = float(width) / w
+    offsetInPixels = x + (w / 2 - cameraWidth / 2)
+    angle = np.arctan(offsetInPixels / -focal)
+    distance = np.cos(angle) * inches_per_pixel
+    distance *= focal
+    offsetInPixels *= inches_per_pixel
+    np.degrees(angle, out=angle)
+    np.negative(offsetInPixels, out=offsetInPixels)
+    return distance, angle, offsetInPixels
@@ -0,0 +1,161 @@
+import cv2 as cv
+import numpy as np
+from collections import namedtuple
+from typing import *
+from threads import get_tls
+
+# How to blur a frame before color thresholding
+# kind is GAUSSIAN, BOX, STACK or NONE, size is the kernel size at full resolution, and level is how many
+# times the frame is halved before blurring (the result is scaled back up to full size)
+BlurSpec = namedtuple("BlurSpec", ("kind", "size", "level"), defaults=("GAUSSIAN", 13, 0))
+blur_kinds = ("GAUSSIAN", "BOX", "STACK", "NONE")
+
+# OpenCV only has stack blur since 4.7
+stack_blur_available = hasattr(cv, "stackBlur")
+
+
+# Make a blur spec from config values, with the scale given as a factor (1, 2, 4, ...)
+def blur_spec(kind: str = "GAUSSIAN", size: int = 13, scale: int = 1) -> BlurSpec:
+    kind = kind.upper()
+    if kind not in blur_kinds:
+        raise ValueError(f"unknown blur {kind}")
+    if kind == "NONE" or size <= 1:
+        return BlurSpec("NONE", 0, 0)
+    return BlurSpec(kind, size, max(int(scale), 1).bit_length() - 1)
+
+
+default_blur = BlurSpec()
+
+
+# Images derived from one frame (blurred, HSV, grayscale, downscaled), shared by every library
+# Each one is computed the first time a library asks for it and reused for the rest of the frame
+# The destination buffers are kept from frame to frame, so once warmed up nothing here allocates
+# The frame may be a region of interest: `origin` is its top left corner in the full camera frame, which
+# libraries add to anything they report, and `mask` (if set) marks which of its pixels are inside the region
+# `camMatrix` and `distCoeffs` are the calibration of the camera the frame came from, if it has one
+class FrameImages:
+    def __init__(self):
+        self.frame = None
+        self.origin = (0, 0)
+        self.mask = None
+        self.camMatrix = None
+        self.distCoeffs = None
+        self.buffers = {}
+        self.valid = set()
+
+    # Start over with a new frame. Must be called whenever the frame's contents change, even if it's
+    # the same array as before (camera buffers are reused)
+    def reset(
+        self,
+        frame: np.ndarray,
+        origin: Tuple[int, int] = (0, 0),
+        mask: Optional[np.ndarray] = None,
+        camMatrix: Optional[np.ndarray] = None,
+        distCoeffs: Optional[np.ndarray] = None,
+    ) -> "FrameImages":
+        self.frame = frame
+        self.origin = origin
+        self.mask = mask
+        self.camMatrix = camMatrix
+        self.distCoeffs = distCoeffs
+        self.valid.clear()
+        return self
+
+    # Black out anything outside the region of interest, in place
+    def apply_mask(self, img: np.ndarray) -> np.ndarray:
+        if self.mask is not None:
+            cv.bitwise_and(img, img, dst=img, mask=self.mask)
+        return img
+
+    # Get the preallocated buffer for a derived image
+    def buffer(self, key, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buf
+        return buf
+
+    # The frame blurred as described by a `BlurSpec`, at full size
+    def blurred(self, blur: BlurSpec = default_blur) -> np.ndarray:
+        if blur.kind == "NONE":
+            return self.frame
+        key = ("blur", blur)
+        if key in self.valid:
+            return self.buffers[key]
+        src = self.pyramid(blur.level)
+        # Keep the kernel odd, and shrink it along with the image
+        ksize = max(blur.size >> blur.level, 1) | 1
+        if blur.level > 0:
+            dst = self.buffer(("blur_small", blur), src.shape)
+        else:
+            dst = self.buffer(key, src.shape)
+        if blur.kind == "BOX":
+            cv.blur(src, (ksize, ksize), dst=dst)
+        elif blur.kind == "STACK" and stack_blur_available:
+            cv.stackBlur(src, (ksize, ksize), dst=dst)
+        else:
+            cv.GaussianBlur(src, (ksize, ksize), 0, dst=dst)
+        if blur.level > 0:
+            h, w = self.frame.shape[:2]
+            buf = self.buffer(key, self.frame.shape)
+            cv.resize(dst, (w, h), dst=buf, interpolation=cv.INTER_LINEAR)
+            dst = buf
+        self.valid.add(key)
+        return dst
+
+    # HSV conversion of the frame, blurred first with `blurred(blur)`
+    def hsv(self, blur: BlurSpec = default_blur) -> np.ndarray:
+        key = ("hsv", blur)
+        if key in self.valid:
+            return self.buffers[key]
+        src = self.blurred(blur)
+        buf = self.buffer(key, src.shape)
+        cv.cvtColor(src, cv.COLOR_BGR2HSV, dst=buf)
+        self.valid.add(key)
+        return buf
+
+    def gray(self) -> np.ndarray:
+        key = "gray"
+        if key in self.valid:
+            return self.buffers[key]
+        buf = self.buffer(key, self.frame.shape[:2])
+        cv.cvtColor(self.frame, cv.COLOR_BGR2GRAY, dst=buf)
+        self.apply_mask(buf)
+        self.valid.add(key)
+        return buf
+
+    # The frame halved in size `level` times (level 0 is the frame itself)
+    def pyramid(self, level: int) -> np.ndarray:
+        if level <= 0:
+            return self.frame
+        key = ("pyr", level)
+        if key in self.valid:
+            return self.buffers[key]
+        src = self.pyramid(level - 1)
+        h, w = src.shape[:2]
+        buf = self.buffer(key, ((h + 1) // 2, (w + 1) // 2, *src.shape[2:]))
+        cv.pyrDown(src, dst=buf)
+        self.valid.add(key)
+        return buf
+
+
+# Get the derived images for a frame on this thread. If `img` isn't the frame they were made from,
+# they're reset for it
+def frame_images(img: np.ndarray) -> FrameImages:
+    images = get_tls("frame_images", FrameImages)
+    if images.frame is not img:
+        images.reset(img)
+    return images
+
+
+# Tell this thread's derived images that there's a new frame, which may be in the same buffer as the last
+def new_frame(
+    img: np.ndarray,
+    origin: Tuple[int, int] = (0, 0),
+    mask: Optional[np.ndarray] = None,
+    camMatrix: Optional[np.ndarray] = None,
+    distCoeffs: Optional[np.ndarray] = None,
+) -> FrameImages:
+    return get_tls("frame_images", FrameImages).reset(
+        img, origin, mask, camMatrix, distCoeffs
+    )
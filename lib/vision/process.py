@@ -0,0 +1,225 @@
+from vision.base import *
+import multiprocessing as mp
+import signal
+from multiprocessing import shared_memory
+from vision.images import new_frame
+
+
+# Results go back to the main process as the raw bytes of their record arrays
+def pack_objects(objs: Union[FoundObjects, List[FoundObject]]) -> Tuple[Any, bytes]:
+    found = FoundObjects.of(objs)
+    return found.ty, found.records.tobytes()
+
+
+def unpack_objects(packed: Tuple[Any, bytes]) -> FoundObjects:
+    ty, data = packed
+    return FoundObjects(ty, np.frombuffer(data, dtype=object_dtype))
+
+
+def _worker(
+    conn,
+    shmName: str,
+    shape: Tuple[int, ...],
+    libs: List[VisionBase],
+    mask: Optional[np.ndarray],
+    calibration: Tuple[Optional[np.ndarray], Optional[np.ndarray]],
+    config: Dict[str, Dict[str, str]],
+):
+    # Ctrl-C and service stops signal the whole process group, but stopping is up to the main process,
+    # which tells the worker (or closes the pipe) once it's done with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    VisionBase.config = config
+    shm = shared_memory.SharedMemory(name=shmName)
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    retired = []
+    img = None
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            if msg[0] == "resize":
+                # A bigger frame buffer, for frames that didn't fit in the old one. The old one is kept open
+                # until the end, since the last frame's derived images may still point into it
+                _, shmName, shape = msg
+                retired.append(shm)
+                shm = shared_memory.SharedMemory(name=shmName)
+                frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                conn.send(None)
+                continue
+            if msg[0] == "reload":
+                # New settings, which apply from the next frame on
+                _, config, mask, calibration = msg
+                VisionBase.config = config
+                for lib in libs:
+                    # A library that fails to compile them keeps its old parameters; the main process
+                    # compiles the same settings first and reports the error
+                    try:
+                        lib.reload()
+                    except Exception:
+                        pass
+                continue
+            _, h, w, cameraWidth, cameraHeight, cameraFOV, origin = msg
+            img = frame[:h, :w]
+            new_frame(img, origin, mask, *calibration)
+            res = {}
+            for lib in libs:
+                try:
+                    res[lib.name] = pack_objects(
+                        lib.find_objects(img, cameraWidth, cameraHeight, cameraFOV)
+                    )
+                except Exception as e:
+                    res[lib.name] = e
+            conn.send(res)
+    finally:
+        del img, frame
+        for block in (*retired, shm):
+            block.close()
+
+
+# Run vision libraries in a worker process, so they don't fight the rest of the program for the GIL
+# Frames are handed over through shared memory, and results come back as packed record arrays
+# The worker is forked from a fork server, a fresh single-threaded process, because forking this one would
+# copy in locks held by its other threads (ntcore, file syncing, cameras). So the libraries are pickled,
+# and the loaded config is sent along with them
+# `mask` and `calibration` (camera matrix, distortion coefficients) apply to every frame (see `FrameImages`)
+# Frames bigger than `shape` get a new, bigger buffer. If the worker dies, that's logged once and the
+# libraries are run in the calling thread from then on, with the parameters they were given in this process
+class VisionProcess:
+    def __init__(
+        self,
+        libs: Iterable[VisionBase],
+        shape: Tuple[int, ...],
+        name: str = "vision",
+        mask: Optional[np.ndarray] = None,
+        calibration: Tuple[Optional[np.ndarray], Optional[np.ndarray]] = (None, None),
+        log_file=None,
+    ):
+        self.libs = list(libs)
+        self.name = name
+        self.log_file = log_file
+        self.alive = True
+        self.shape = shape
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+        ctx = mp.get_context("forkserver")
+        # The fork server only needs this module, not whichever script is running
+        ctx.set_forkserver_preload(["vision.process"])
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(
+            target=_worker,
+            args=(
+                child,
+                self.shm.name,
+                shape,
+                self.libs,
+                mask,
+                calibration,
+                VisionBase.config,
+            ),
+            name=name,
+            daemon=True,
+        )
+        self.proc.start()
+        child.close()
+
+    # Same as calling `find_objects` for each library, but in the worker
+    # `origin` is where `imgRaw` is in the full frame, if it's a region of interest
+    def find_objects(
+        self,
+        imgRaw: np.ndarray,
+        cameraWidth: int,
+        cameraHeight: int,
+        cameraFOV: int,
+        origin: Tuple[int, int] = (0, 0),
+    ) -> Dict[str, FoundObjects]:
+        if not self.alive:
+            return self.find_objects_here(imgRaw, cameraWidth, cameraHeight, cameraFOV)
+        h, w = imgRaw.shape[:2]
+        sh, sw = self.shape[:2]
+        try:
+            if h > sh or w > sw or imgRaw.shape[2:] != self.shape[2:]:
+                self.resize((max(h, sh), max(w, sw), *imgRaw.shape[2:]))
+            np.copyto(self.frame[:h, :w], imgRaw)
+            self.conn.send(
+                ("frame", h, w, cameraWidth, cameraHeight, cameraFOV, origin)
+            )
+            res = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.died(e)
+            return self.find_objects_here(imgRaw, cameraWidth, cameraHeight, cameraFOV)
+        for name, packed in res.items():
+            if isinstance(packed, Exception):
+                raise packed
+            res[name] = unpack_objects(packed)
+        return res
+
+    # Run the libraries in the calling thread instead, once the worker is gone
+    # `new_frame` has already been called for `imgRaw` by then, as it is for the worker
+    def find_objects_here(
+        self, imgRaw: np.ndarray, cameraWidth: int, cameraHeight: int, cameraFOV: int
+    ) -> Dict[str, FoundObjects]:
+        return {
+            lib.name: FoundObjects.of(
+                lib.find_objects(imgRaw, cameraWidth, cameraHeight, cameraFOV)
+            )
+            for lib in self.libs
+        }
+
+    # Replace the shared frame buffer with one of `shape`, and tell the worker to switch to it
+    # The old buffer is only removed once the worker has opened the new one, since it may not have even
+    # opened the old one yet
+    def resize(self, shape: Tuple[int, ...]):
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        old = self.shm
+        del self.frame
+        self.shm = shm
+        self.shape = shape
+        self.frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        try:
+            self.conn.send(("resize", shm.name, shape))
+            self.conn.recv()
+        finally:
+            old.close()
+            old.unlink()
+        if self.log_file is not None:
+            self.log_file.write(f"Resized {self.name}'s frame buffer to {shape}\n")
+
+    def died(self, error: Exception):
+        self.alive = False
+        if self.log_file is not None:
+            self.log_file.write(
+                "Vision worker {} died ({!r}), running its libraries in this thread\n".format(
+                    self.name, error
+                )
+            )
+
+    # Replace the vision settings, mask and calibration in the worker, and recompile its libraries' parameters
+    # Must be called from the thread calling `find_objects`, between frames
+    def reload(
+        self,
+        config: Dict[str, Dict[str, str]],
+        mask: Optional[np.ndarray],
+        calibration: Tuple[Optional[np.ndarray], Optional[np.ndarray]],
+    ):
+        if not self.alive:
+            return
+        try:
+            self.conn.send(("reload", config, mask, calibration))
+        except OSError as e:
+            self.died(e)
+
+    def close(self):
+        if self.alive and self.proc.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.proc.join(1.0)
+            if self.proc.is_alive():
+                self.proc.terminate()
+        self.conn.close()
+        del self.frame
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,117 @@
+import time
+import ntcore
+import numpy as np
+from typing import *
+from vision.base import FoundObjects
+from camera.base import FrameInfo
+
+# The fields published for rings and tags, as topic name: record field
+ring_fields = {"distance": "distance", "angle": "angle", "offset": "offset"}
+tag_fields = {"distance": "distance", "angle": "angle", "offset": "offset", "id": "ident"}
+
+# How far a field has to move from what was last published before it's published again, by topic name
+# (distance and offset in inches, angle in degrees); fields not listed are published on any change
+default_deadbands = {"distance": 0.1, "angle": 0.1, "offset": 0.1}
+
+
+# Get the current NetworkTables time, in microseconds
+def nt_now() -> int:
+    return ntcore._now()
+
+
+# Convert a `time.monotonic()` time to NetworkTables time, in microseconds
+def nt_time(monotonic: float) -> int:
+    return nt_now() - int((time.monotonic() - monotonic) * 1_000_000)
+
+
+# Publishes found objects to NetworkTables through publishers created up front, so a frame takes the same
+# few calls however many objects there are, and no keys are left behind when there are fewer than before
+# Each field goes to <prefix>.<name> as a double array with one element per object (missing values are
+# `missing`), and the count to <prefix>Found
+# To save bandwidth, a field is only sent when one of its values has moved more than its deadband since it
+# was last sent. When the number of objects changes everything is sent, so objects that vanished are
+# cleared right away
+class ObjectPublisher:
+    def __init__(
+        self,
+        table: ntcore.NetworkTable,
+        prefix: str,
+        fields: Dict[str, str],
+        missing: float = -9999.0,
+        deadbands: Dict[str, float] = default_deadbands,
+    ):
+        self.fields = fields
+        self.missing = missing
+        self.deadbands = {name: deadbands.get(name, 0.0) for name in fields}
+        self.countPub = table.getDoubleTopic(f"{prefix}Found").publish()
+        self.arrayPubs = {
+            name: table.getDoubleArrayTopic(f"{prefix}.{name}").publish()
+            for name in fields
+        }
+        self.lastCount = -1
+        self.last = {name: None for name in fields}
+
+    # Publish a frame's objects, all with the timestamp `time` (0 is now)
+    # Returns whether anything was sent
+    def publish(self, objs: FoundObjects, time: int = 0) -> bool:
+        count = len(objs)
+        recount = count != self.lastCount
+        if recount:
+            self.countPub.set(count, time)
+            self.lastCount = count
+        sent = recount
+        for name, field in self.fields.items():
+            values = objs.column(field, self.missing)
+            if not recount and (
+                count == 0
+                or np.max(np.abs(values - self.last[name])) <= self.deadbands[name]
+            ):
+                continue
+            self.arrayPubs[name].set(values.tolist(), time)
+            self.last[name] = values
+            sent = True
+        return sent
+
+    def close(self):
+        self.countPub.close()
+        for pub in self.arrayPubs.values():
+            pub.close()
+
+
+# Lets something happen at most once every `period` seconds, for topics that don't need to be sent with
+# every frame
+class RateLimit:
+    def __init__(self, period: float):
+        self.period = period
+        self.next = 0.0
+
+    # Whether it's time again, as of `now` (`time.monotonic()`)
+    def __call__(self, now: float) -> bool:
+        if now < self.next:
+            return False
+        self.next = now + self.period
+        return True
+
+
+# Publishes where a frame's results came from, so the robot can match them up with where it was then
+# FrameId counts up with every frame the camera captures, Latency is the time from capture to results in
+# ms, and Timestamp is the capture time in microseconds of NT server time (or of local NT time, while the
+# clocks aren't synced)
+class FrameInfoPublisher:
+    def __init__(self, inst: ntcore.NetworkTableInstance, table: ntcore.NetworkTable):
+        self.inst = inst
+        self.idPub = table.getIntegerTopic("FrameId").publish()
+        self.latencyPub = table.getDoubleTopic("Latency").publish()
+        self.timePub = table.getIntegerTopic("Timestamp").publish()
+
+    # Publish a frame's info, all with the timestamp `time`, which is when it was captured in local NT time
+    def publish(self, info: FrameInfo, time: int):
+        offset = self.inst.getServerTimeOffset()
+        self.idPub.set(info.frameId, time)
+        self.latencyPub.set(info.latency * 1000, time)
+        self.timePub.set(time if offset is None else time + offset, time)
+
+    def close(self):
+        self.idPub.close()
+        self.latencyPub.close()
+        self.timePub.close()
@@ -1,72 +1,121 @@
 from vision.base import *
+from collections import namedtuple
+
+# Settings of a `RectVisionLibrary`, compiled from its section of the vision settings
+RectParams = namedtuple(
+    "RectParams",
+    (
+        "hsvMin",
+        "hsvMax",
+        "minArea",
+        "tolerance",
+        "minAspect",
+        "minVis",
+        "width",
+        "height",
+        "reciprocal",
+        "blur",
+        "aspect",
+    ),
+)
 
 
 class RectVisionLibrary(VisionBase):
     # Define class initialization
     def __init__(self, name):
+        super().__init__()
         self.name = name
-        super()
+        self.reload()
+
+    # Read configuration values from dictionary and make tuples
+    def compile_params(self) -> RectParams:
+        width = self.cfg("WIDTH", None, float)
+        height = self.cfg("HEIGHT", None, float)
+        return RectParams(
+            hsvMin=(
+                self.cfg("HMIN", 0, int),
+                self.cfg("SMIN", 0, int),
+                self.cfg("VMIN", 0, int),
+            ),
+            hsvMax=(
+                self.cfg("HMAX", 255, int),
+                self.cfg("SMAX", 255, int),
+                self.cfg("VMAX", 255, int),
+            ),
+            minArea=self.cfg("MINAREA", 0, int),
+            tolerance=self.cfg("TOLERANCE", 10.0, float),
+            minAspect=self.cfg("MINASPECT", 0.0, float, False),
+            minVis=self.cfg("MINVIS", 0.0, float, False),
+            width=width,
+            height=height,
+            reciprocal=self.cfg("RECIPROCAL", False, bool, False),
+            blur=self.cfg_blur(),
+            aspect=height / width,
+        )
 
     # Locates the cubes and cones in the game (2023)
     # returns a tuple containing (cubes, cones)
     def find_objects(
         self, imgRaw: np.ndarray, cameraWidth: int, cameraHeight: int, cameraFOV: int
-    ) -> List[FoundObject]:
-        # Read configuration values from dictionary and make tuples
-        HSVMin = (
-            self.cfg("HMIN", 0, int),
-            self.cfg("SMIN", 0, int),
-            self.cfg("VMIN", 0, int),
-        )
-        HSVMax = (
-            self.cfg("HMAX", 255, int),
-            self.cfg("SMAX", 255, int),
-            self.cfg("VMAX", 255, int),
-        )
-        minArea = self.cfg("MINAREA", 0, int)
-        tolerance = self.cfg("TOLERANCE", 10.0, float)
-        minAspect = self.cfg("MINASPECT", 0.0, float, False)
-        minVis = self.cfg("MINVIS", 0.0, float, False)
-        width = self.cfg("WIDTH", None, float)
-        height = self.cfg("HEIGHT", None, float)
-        recip = self.cfg("RECIPROCAL", False, bool, False)
-        aspect = height / width
+    ) -> FoundObjects:
+        params = self.params
+        minArea = params.minArea
+        tolerance = params.tolerance
+        minAspect = params.minAspect
+        minVis = params.minVis
+        recip = params.reciprocal
+        aspect = params.aspect
 
         # Initialize variables
-        data = []
+        ox, oy = frame_images(imgRaw).origin
 
         # Find contours in the mask and clean up the return style from OpenCV
-        contours = self.process_image_contours(imgRaw, HSVMin, HSVMax, False, False)
-        if len(contours) > 0:
-            contours.sort(key=cv.contourArea, reverse=True)
-            for contour in contours:
-                x, y, w, h = cv.boundingRect(contour)
+        contours = self.process_image_contours(
+            imgRaw, params.hsvMin, params.hsvMax, False, False, params.blur
+        )
+        found = FoundObjects(self.name)
+        if len(contours) == 0:
+            return found
 
-                if w * h < minArea:  # in pixel units
-                    break
+        # Bounding boxes of the contours that pass the filters, largest first
+        boxes = []
+        areas = [cv.contourArea(contour) for contour in contours]
+        for i in sorted(range(len(contours)), key=areas.__getitem__, reverse=True):
+            x, y, w, h = cv.boundingRect(contours[i])
 
-                if h / w < minAspect or (
-                    abs(h / w / aspect - 1.0) > tolerance
-                    or (recip and abs(w / h / aspect - 1.0) > tolerance)
-                ):
-                    continue
-                if cv.contourArea(contour) / (w * h) < minVis:
-                    continue
+            if w * h < minArea:  # in pixel units
+                break
 
-                data.append(
-                    populate_obj(
-                        FoundObject(
-                            self.name,
-                            x,
-                            y,
-                            w=w,
-                            h=h,
-                        ),
-                        width,
-                        cameraWidth,
-                        cameraHeight,
-                        cameraFOV,
-                    )
-                )
+            if h / w < minAspect or (
+                abs(h / w / aspect - 1.0) > tolerance
+                or (recip and abs(w / h / aspect - 1.0) > tolerance)
+            ):
+                continue
+            if areas[i] / (w * h) < minVis:
+                continue
+
+            boxes.append((x + ox, y + oy, w, h))
 
-        return data
+        if len(boxes) == 0:
+            return found
+
+        # Work out where they are, straight into the result array. There are usually only a few, which are
+        # quicker one by one; it's only worth doing them all at once when there are many
+        found = FoundObjects(self.name, count=len(boxes))
+        records = found.records
+        records["x"], records["y"], records["w"], records["h"] = zip(*boxes)
+        if len(boxes) < metrics_batch_min:
+            records["distance"], records["angle"], records["offset"] = zip(
+                *(
+                    object_metrics(x, w, params.width, cameraWidth, cameraFOV)
+                    for x, _, w, _ in boxes
+                )
+            )
+            return found
+        distances, angles, offsets = populate_metrics(
+            records["x"], records["w"], params.width, cameraWidth, cameraFOV
+        )
+        records["distance"] = distances
+        records["angle"] = angles
+        records["offset"] = offsets
+        return found
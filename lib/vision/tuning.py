@@ -0,0 +1,124 @@
+import threading
+import functools
+import ntcore
+from collections import deque
+from typing import *
+from vision.base import VisionBase
+from settings import write_settings
+from threads import KillableThread, StopToken
+
+
+# Publishes the settings of vision libraries to NetworkTables and applies changes made there (e.g. from a
+# dashboard) to the running libraries
+# Each library's settings go under <tableName>/<library name>, as numbers where they parse as one and as
+# strings otherwise. Changes arrive through ntcore listeners, so nothing is read from NT per frame; they're
+# compiled into new parameters and swapped in (see `VisionBase.update_config`), which the vision loops pick up
+# on their next frame
+# If `file` is given, setting <tableName>/<library name>/Save to true writes that library's settings to it
+class LiveTuning:
+    def __init__(
+        self,
+        inst: ntcore.NetworkTableInstance,
+        libs: Iterable[VisionBase],
+        tableName: str = "Tuning",
+        file: Optional[str] = None,
+        log_file=None,
+    ):
+        self.inst = inst
+        self.file = file
+        self.log_file = log_file
+        self.libs = {}
+        for lib in libs:
+            self.libs.setdefault(lib.name, []).append(lib)
+        self.changes = deque()
+        self.pending = threading.Event()
+        self.tables = {}
+        self.listeners = []
+        root = inst.getTable(tableName)
+        for name in self.libs:
+            table = root.getSubTable(name)
+            self.tables[name] = table
+            self.publish(name)
+            if file is not None:
+                table.putBoolean("Save", False)
+            self.listeners.append(
+                table.addListener(
+                    ntcore.EventFlags.kValueRemote, functools.partial(self._changed, name)
+                )
+            )
+        self.thread = KillableThread(target=self._run, name="tuning", token=StopToken())
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Put a library's current settings to its table
+    def publish(self, name: str):
+        table = self.tables[name]
+        for key, text in VisionBase.config.get(name, {}).items():
+            try:
+                table.putNumber(key, float(text))
+            except ValueError:
+                table.putString(key, text)
+
+    # Put every library's settings, e.g. after the settings file was reloaded
+    def publish_all(self):
+        for name in self.tables:
+            self.publish(name)
+
+    # Runs on ntcore's listener thread, which mustn't call back into ntcore, so changes are queued for
+    # `_run` to apply
+    def _changed(self, name: str, table, key: str, event: ntcore.Event):
+        self.changes.append((name, key, event.data.value))
+        self.pending.set()
+
+    def _run(self):
+        token = self.thread.token
+        while not token.stopped:
+            self.pending.wait()
+            self.pending.clear()
+            while len(self.changes) > 0 and not token.stopped:
+                self.apply(*self.changes.popleft())
+
+    def apply(self, name: str, key: str, value: ntcore.Value):
+        if key == "Save":
+            if value.isBoolean() and value.getBoolean():
+                self.save(name)
+                self.tables[name].putBoolean("Save", False)
+            return
+        if value.isDouble():
+            num = value.getDouble()
+            text = str(int(num)) if num.is_integer() else str(num)
+        elif value.isString():
+            text = value.getString()
+        else:
+            return
+        try:
+            VisionBase.update_config(name, {key: text}, self.libs[name])
+            self.log(f"Tuned {name} {key}={text}\n")
+        except Exception as e:
+            self.log(
+                f"Error tuning {name} {key}={text}, keeping the old value:\n    {e}\n"
+            )
+            # Show what's actually in use
+            self.publish(name)
+
+    # Write a library's settings back to the settings file
+    def save(self, name: str):
+        if self.file is None:
+            return
+        try:
+            write_settings(self.file, name, VisionBase.config.get(name, {}))
+            self.log(f"Saved {name} settings to {self.file}\n")
+        except OSError as e:
+            self.log(f"Error saving {name} settings to {self.file}:\n    {e}\n")
+
+    def log(self, msg: str):
+        if self.log_file is not None:
+            self.log_file.write(msg)
+
+    def close(self, timeout: float = 1.0):
+        for listener in self.listeners:
+            self.inst.removeListener(listener)
+        self.listeners = []
+        self.thread.kill()
+        self.pending.set()
+        self.thread.join(timeout)
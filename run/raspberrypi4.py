@@ -5,19 +5,15 @@ import sys
 import os
 import time
 
-def unwrap_or(val, default):
-    if val is None:
-        return default
-    else:
-        return val
-
-
 team4121home = os.getenv("TEAM4121HOME", os.getcwd())
 team4121config = os.getenv("TEAM4121CONFIG", "2024")
 team4121logs = os.getenv("TEAM4121LOGS", team4121home + "/logs")
 team4121visiontest = os.getenv("TEAM4121VISIONTEST", "True")
 team4121camerasync = os.getenv("TEAM4121CAMERASYNC", "False")
 team4121videosave = os.getenv("TEAM4121VIDEOSAVE", "False")
+team4121processmode = os.getenv("TEAM4121PROCESSMODE", "False")
+team4121profile = os.getenv("TEAM4121PROFILE", "False")
+team4121tuningsave = os.getenv("TEAM4121TUNINGSAVE", "False")
 cameralist = os.getenv("TEAM4121CAMERALIST", "INTAKE,SHOOTER")
 nt_server_addr = os.getenv("NT_SERVER_ADDR", "10.41.21.2")
 
@@ -36,11 +32,17 @@ import numpy as np
 # Team 4121 module imports
 # import camera.picam
 import camera.frame
+import camera.video
 from camera.usb import UsbCamera
 from camera.base import *
+from camera.overlay import OverlayRenderer
 from vision.glob._2024 import *
 from threads import KillableThread
-from flush import flush
+from flush import flush, durability
+from settings import SettingsWatcher, parse_settings
+from control import ControlPlane
+from vision.tuning import LiveTuning
+from vision.publish import *
 
 # Declare global variables
 cameraFile = team4121home + "/config/" + team4121config + "/CameraSettings.txt"
@@ -51,6 +53,9 @@ cameraValues = {}
 videoTesting = team4121visiontest.lower() in ["true", "1", "t", "y", "yes"]
 syncCamera = team4121camerasync.lower() in ["true", "1", "t", "y", "yes"]
 saveVideo = team4121videosave.lower() in ["true", "1", "t", "y", "yes"]
+processMode = team4121processmode.lower() in ["true", "1", "t", "y", "yes"]
+profileMode = team4121profile.lower() in ["true", "1", "t", "y", "yes"]
+saveTuning = team4121tuningsave.lower() in ["true", "1", "t", "y", "yes"]
 resizeVideo = False
 networkTablesConnected = True
 startupSleep = 0
@@ -70,25 +75,8 @@ timeString = "{:0>2}-{:0>2}-{:0>2}_{:0>2}{:0>2}{:0>2}".format(
 
 nt = ntcore.NetworkTableInstance.getDefault()
 
-stop = False
-
-class PollerFn:
-    def __init__(self, call: Callable[[], Any], maxCount: int = 50):
-        self.ret = call()
-        self.call = call
-        self.count = 0
-        self.maxCount = maxCount
-
-    def __call__(self, force=False):
-        if force or self.count >= self.maxCount:
-            self.ret = self.call()
-            self.count = 0
-            return self.ret
-        self.count += 1
-        return self.ret
-
-
-ntIsConnected = PollerFn(lambda: nt.isConnected())
+# NT connection state, camera enables and the stop signal, pushed in by ntcore listeners
+control = ControlPlane(nt)
 
 class CameraCallback:
     def __init__(self, table, cam):
@@ -100,9 +88,24 @@ class CameraCallback:
         self.maxFps = 0
         self.avgFps = 0
         self.lastTime = time.monotonic()
+        self.fpsPub = table.getDoubleTopic("FPS").publish()
+        self.infoPub = FrameInfoPublisher(nt, table)
+        deadbands = {
+            name: float(cam.get_config(f"DEADBAND_{name.upper()}", band))
+            for name, band in default_deadbands.items()
+        }
+        self.ringPub = ObjectPublisher(table, "Rings", ring_fields, deadbands=deadbands)
+        self.tagPub = ObjectPublisher(table, "Tags", tag_fields, deadbands=deadbands)
+        self.housekeeping = RateLimit(float(cam.get_config("NT_PERIOD", 0.5)))
+        self.overlay = OverlayRenderer()
         self.table.putBoolean("Enabled", True)
 
-    def __call__(self, frame: np.ndarray, res: Dict[str, List[FoundObject]]):
+    def __call__(
+        self,
+        frame: np.ndarray,
+        res: Dict[str, FoundObjects],
+        info: Optional[FrameInfo] = None,
+    ):
         fieldTime = time.monotonic()
         fieldFps = 1 / (fieldTime - self.lastTime)
         self.lastTime = fieldTime
@@ -113,132 +116,32 @@ class CameraCallback:
             self.minFps = fieldFps
         if self.frames < 15 and fieldFps > self.maxFps:
             self.maxFps = fieldFps
-        rings = res["RING"] if "RING" in res else []
-        tags = res["APRIL"] if "APRIL" in res else []
+        rings = FoundObjects.of(res.get("RING", []), "RING")
+        tags = FoundObjects.of(res.get("APRIL", []), "TAG")
         if videoTesting:
-            cv.putText(
-                frame,
+            # Draw on a copy, so the camera's buffer is left alone
+            self.frame = self.overlay.draw(
+                frame.copy(),
+                {"RING": rings, "APRIL": tags},
                 "{:4.1f}/{:4.1f}/{:4.1f}/{:4.1f} FPS".format(
                     fieldFps, self.avgFps, self.minFps, self.maxFps
                 ),
-                (0, 15),
-                cv.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                (255, 255, 255),
-                1,
             )
-            for ring in rings:
-                cv.rectangle(
-                    frame,
-                    (ring.x, ring.y),
-                    ((ring.x + ring.w), (ring.y + ring.h)),
-                    (0, 0, 255),
-                    2,
-                )
-                cv.putText(
-                    frame,
-                    "D: {:6.2f}".format(ring.distance),
-                    (ring.x + 10, ring.y + 15),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-                cv.putText(
-                    frame,
-                    "A: {:6.2f}".format(ring.angle),
-                    (ring.x + 10, ring.y + 30),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-                cv.putText(
-                    frame,
-                    "O: {:6.2f}".format(ring.offset),
-                    (ring.x + 10, ring.y + 45),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-            for tag in tags:
-                cv.rectangle(
-                    frame,
-                    (tag.x, tag.y),
-                    ((tag.x + tag.w), (tag.y + tag.h)),
-                    (255, 0, 255),
-                    2,
-                )
-                cv.putText(
-                    frame,
-                    "D: {:6.2f}".format(tag.distance),
-                    (tag.x + 10, tag.y + 15),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-                cv.putText(
-                    frame,
-                    "A: {:6.2f}".format(tag.angle),
-                    (tag.x + 10, tag.y + 30),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-                cv.putText(
-                    frame,
-                    "O: {:6.2f}".format(tag.offset),
-                    (tag.x + 10, tag.y + 45),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-                cv.putText(
-                    frame,
-                    "I: {}".format(tag.ident),
-                    (tag.x + 10, tag.y + 60),
-                    cv.FONT_HERSHEY_SIMPLEX,
-                    0.3,
-                    (0, 255, 0),
-                    1,
-                )
-
-        self.frame = frame
-
-        if ntIsConnected():
-            self.table.putNumber("FPS", fieldFps)
-
-            self.table.putNumber("RingsFound", len(rings))
-
-            for i in range(len(rings)):
-                self.table.putNumber(
-                    f"Rings.{i}.distance", unwrap_or(rings[i].distance, -9999.0)
-                )
-                self.table.putNumber(
-                    f"Rings.{i}.angle", unwrap_or(rings[i].angle, -9999.0)
-                )
-                self.table.putNumber(
-                    f"Rings.{i}.offset", unwrap_or(rings[i].offset, -9999.0)
-                )
-
-            self.table.putNumber("TagsFound", len(tags))
-            for i in range(len(tags)):
-                self.table.putNumber(
-                    f"Tags.{i}.distance", unwrap_or(tags[i].distance, -9999.0)
-                )
-                self.table.putNumber(
-                    f"Tags.{i}.angle", unwrap_or(tags[i].angle, -9999.0)
-                )
-                self.table.putNumber(
-                    f"Tags.{i}.offset", unwrap_or(tags[i].offset, -9999.0)
-                )
-                self.table.putNumber(f"Tags.{i}.id", unwrap_or(tags[i].ident, -9999.0))
-
-            self.cam.enabled = self.table.getBoolean("Enabled", True)
+        else:
+            self.frame = frame
+
+        if control.connected:
+            # Everything from this frame goes out timestamped with when it was captured, and only what
+            # changed is sent. The frame info goes with any change, and with the FPS every NT_PERIOD
+            # seconds so the robot can tell the camera's still running
+            now = nt_now() if info is None else nt_time(info.captureTime)
+            sent = self.ringPub.publish(rings, now)
+            sent = self.tagPub.publish(tags, now) or sent
+            housekeeping = self.housekeeping(fieldTime)
+            if housekeeping:
+                self.fpsPub.set(self.avgFps, now)
+            if info is not None and (sent or housekeeping):
+                self.infoPub.publish(info, now)
 
         self.frames += 1
 
@@ -252,7 +155,9 @@ class CameraLoop:
     ):
         if type(cam) is str:
             self.name = cam
-            self.cam = CameraBase.init_cam(cam, timeString, params._replace(videofile=saveVideo))
+            self.cam = CameraBase.init_cam(
+                cam, timeString, params._replace(videofile=saveVideo, profile=profileMode)
+            )
         else:
             self.name = cam.name
             self.cam = cam
@@ -263,9 +168,33 @@ class CameraLoop:
         if type(table) is str:
             table = nt.getTable(table)
 
+        self.table = table
         self.callback = CameraCallback(table, self.cam)
+        self.cam.profilePublish = self.publish_profile
+        self.cam.onEnd = self.ended
+        # Enabled is pushed into the camera when it changes, rather than read every frame
+        control.watch(table, "Enabled", self.set_enabled)
         self.libs = (RingVisionLibrary(), AprilTagVisionLibrary())
         # self.libs = [VisionBase()] * 2
+        if processMode:
+            # Threads are already running by now, which is why the worker comes from a fork server instead of
+            # a fork of this process (see `VisionProcess`)
+            self.cam.use_process(*self.libs)
+
+    # Put the profiler's stage percentiles (p50/p95/p99/mean, in ms) to the table
+    def publish_profile(self, stats: Dict[str, Tuple[float, ...]]):
+        if control.connected:
+            for stage, vals in stats.items():
+                self.table.putNumberArray(f"Profile.{stage}", vals)
+
+    # Runs on the camera's thread when it runs out of frames (a VIDEO camera with STOP_AT_END)
+    def ended(self):
+        control.stop(f"{self.name} ran out of frames\n")
+
+    # Runs on ntcore's listener thread
+    def set_enabled(self, value: ntcore.Value):
+        if value.isBoolean():
+            self.cam.enabled = value.getBoolean()
 
     def launch_loop(self) -> KillableThread:
         self.thread = self.cam.launch_libs_loop(*self.libs, callback=self.callback)
@@ -291,7 +220,9 @@ def main():
     # Open a log file
     safeName = cameralist.replace(",", "_")
     
-    if cam := UsbCamera.setup_from_env(timeString, CameraParams(videofile=saveVideo)):
+    if cam := UsbCamera.setup_from_env(
+        timeString, CameraParams(videofile=saveVideo, profile=profileMode)
+    ):
         safeName = cam.name
 
     logFilename = "{}/run/log_{}_{}.txt".format(team4121logs, safeName, timeString)
@@ -299,7 +230,9 @@ def main():
 
     with open(logFilename, "a") as log_file:
         cams = []
-        flushLog = PollerFn(lambda: log_file.flush())
+        flushLog = RateLimit(0.5)
+        control.log_file = log_file
+        durability.register(log_file)
         try:
             log_file.write(f"RUNLOG: {logFilename}\n")
             log_file.write("Run started on {}.\n".format(time.ctime()))
@@ -322,26 +255,20 @@ def main():
                     controlTable = nt.getTable("control")
 
                     controlTable.putNumber("RobotStop", 0)
+                    control.watch_stop(controlTable, "RobotStop")
 
                     timeString = controlTable.getString("Time", timeString)
 
-                    # networkTablesConnected = ntIsConnected()
             except Exception as e:
                 log_file.write("Error:  Unable to connect to Network tables.\n")
                 log_file.write("Error message: {}\n".format(e))
 
             log_file.write(
                 "Connected to table\n"
-                if ntIsConnected(True)
-                else "Failed to connect to table\n"
+                if control.connected
+                else "Not connected to table yet\n"
             )
 
-            def checkStopFn():
-                if ntIsConnected() and controlTable.getNumber("RobotStop", 0) == 1:
-                    log_file.write("Received stop signal from NT\n")
-                    stop = True
-
-            checkStop = PollerFn(checkStopFn)
             if cam is not None:
                 cams = [CameraLoop(cam, timeString)]
             else:
@@ -352,34 +279,61 @@ def main():
             for cam in cams:
                 cam.cam.post_init()
 
+            # Publish the vision settings for tuning from the dashboard
+            tuning = LiveTuning(
+                nt,
+                [lib for cam in cams for lib in cam.libs],
+                file=visionFile if saveTuning else None,
+                log_file=log_file,
+            )
+
+            # Reload the settings files when they're edited, without restarting
+            # Either every camera (or library) gets the new settings or, if any can't use them, none do
+            def reloadCameras():
+                config = parse_settings(cameraFile)
+                if config is None:
+                    raise FileNotFoundError(cameraFile)
+                CameraBase.swap_config(config, [cam.cam for cam in cams])
+
+            def reloadVision():
+                config = parse_settings(visionFile)
+                if config is None:
+                    raise FileNotFoundError(visionFile)
+                libs = [lib for cam in cams for lib in cam.libs]
+                VisionBase.swap_config(config, libs)
+                tuning.publish_all()
+
+            settingsWatcher = SettingsWatcher(log_file=log_file)
+            settingsWatcher.watch(cameraFile, reloadCameras)
+            settingsWatcher.watch(visionFile, reloadVision)
+            settingsWatcher.start()
+
             if not syncCamera:
                 threads = [cam.launch_loop() for cam in cams]
             start = time.monotonic()
             # Start main processing loop
-            while not stop:
-                if videoTesting:
-                    for cam in cams:
-                        cam.update_video()
-
-                #################################
-                # Check for stopping conditions #
-                #################################
-
-                # Check for stop code from keyboard (for testing)
-                if videoTesting and cv.waitKey(1) == 27:
-                    log_file.write("Received stop signal from ESC\n")
-                    break
-
-                # Check for stop code from network tables
-                checkStop()
-                flushLog()
-
-                if syncCamera:
-                    for cam in cams:
-                        cam.cam_tick_sync()
-
-                if not (syncCamera or videoTesting):
-                    time.sleep(0.01)
+            # The stop signal from NT sets `control`'s event, so unless there's video to show or cameras to
+            # tick, the main thread just waits on it. Signals only set a flag, seen when the wait times out
+            if videoTesting or syncCamera:
+                while not control.stopped:
+                    if videoTesting:
+                        for cam in cams:
+                            cam.update_video()
+
+                        # Check for stop code from keyboard (for testing)
+                        if cv.waitKey(1) == 27:
+                            log_file.write("Received stop signal from ESC\n")
+                            break
+
+                    if syncCamera:
+                        for cam in cams:
+                            cam.cam_tick_sync()
+
+                    if flushLog(time.monotonic()):
+                        log_file.flush()
+            else:
+                while not control.wait(flushLog.period):
+                    log_file.flush()
             end = time.monotonic()
 
             for cam in cams:
@@ -397,6 +351,10 @@ def main():
             if videoTesting:
                 cv.destroyAllWindows()
 
+            settingsWatcher.stop()
+            tuning.close()
+            control.close()
+
             for cam in cams:
                 cam.cam.kill = True
 
@@ -413,6 +371,18 @@ def main():
             for thread in threads:
                 thread.kill()
 
+            durability.stop()
+            syncStats = durability.stats()
+            log_file.write(
+                "File syncs: {} in {} passes ({} over budget), {:.1f}/{:.1f} ms mean/max\n".format(
+                    syncStats.syncs,
+                    syncStats.passes,
+                    syncStats.overruns,
+                    syncStats.mean * 1000,
+                    syncStats.max * 1000,
+                )
+            )
+
             # Close the log file
             log_file.write("Run stopped on {}.\n".format(time.ctime()))
         except Exception as e:
@@ -424,8 +394,7 @@ def main():
 if __name__ == "__main__":
 
     def stopit(*args):
-        global stop
-        stop = True
+        control.request_stop()
 
     import signal
     import gc
@@ -0,0 +1,623 @@
+######################################################
+#                                                    #
+#                 Vision Benchmarks                  #
+#                                                    #
+#  This program measures the throughput of pieces    #
+#  of the vision pipeline, so that changes to them   #
+#  can be compared on the same machine.              #
+#                                                    #
+#  Run from the repository root, e.g.                #
+#      python tests/VisionBenchmark.py threads       #
+#                                                    #
+#  @Version: 1.0                                     #
+#  @Created: 2024-3-2                                #
+#  @Author: Team 4121                                #
+#                                                    #
+######################################################
+"""FRC 4121 - Benchmarks for the vision pipeline"""
+
+# System imports
+import sys
+import os
+import argparse
+import glob
+import math
+import pickle
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+team4121home = os.getenv("TEAM4121HOME", os.getcwd())
+team4121config = os.getenv("TEAM4121CONFIG", "2024")
+team4121videos = os.getenv("TEAM4121VIDEOS", team4121home + "/videos")
+
+# Setup paths
+sys.path.append(team4121home + "/lib")
+
+# Module imports
+import cv2 as cv
+import numpy as np
+
+# Team 4121 module imports
+import camera.frame
+from camera.base import *
+from vision.base import populate_metrics
+from vision.glob._2024 import *
+from vision.process import VisionProcess, pack_objects, unpack_objects
+from vision.images import new_frame
+from vision.apriltag import corners as tag_corners, cvt_results
+
+cameraFile = team4121home + "/config/" + team4121config + "/CameraSettings.txt"
+visionFile = team4121home + "/config/" + team4121config + "/VisionSettings.txt"
+timeString = time.strftime("%Y-%m-%d_%H%M%S") + "_bench"
+
+vision_libs = {
+    "RING": RingVisionLibrary,
+    "APRIL": AprilTagVisionLibrary,
+}
+
+
+def load_config():
+    CameraBase.read_config_file(cameraFile)
+    VisionBase.read_vision_file(visionFile)
+
+
+def make_libs(names: str) -> List[VisionBase]:
+    return [vision_libs[name.strip()]() for name in names.split(",") if name.strip()]
+
+
+# Load frames from a recorded video, defaulting to the newest one in the videos directory
+def load_video(path: Optional[str], limit: int) -> List[np.ndarray]:
+    if path is None:
+        videos = sorted(glob.glob(team4121videos + "/*.avi"), key=os.path.getmtime)
+        if len(videos) == 0:
+            raise SystemExit("no recorded videos found in " + team4121videos)
+        path = videos[-1]
+    cap = cv.VideoCapture(path)
+    frames = []
+    while len(frames) < limit:
+        good, frame = cap.read()
+        if not good:
+            break
+        frames.append(frame)
+    cap.release()
+    if len(frames) == 0:
+        raise SystemExit("couldn't read any frames from " + path)
+    print("loaded {} frames from {}".format(len(frames), path))
+    return frames
+
+
+# A thread that is killed with `sys.settrace`, the way `KillableThread` used to work
+# Kept here so the cost of tracing can be compared against cooperative cancellation
+class TracedThread(threading.Thread):
+    def __init__(self, target: Callable, args: Iterable = ()):
+        threading.Thread.__init__(self, target=target, args=args, daemon=True)
+        self.killed = False
+
+    def run(self):
+        sys.settrace(self.globaltrace)
+        threading.Thread.run(self)
+
+    def globaltrace(self, frame, event, arg):
+        if event == "call":
+            return self.localtrace
+        else:
+            return None
+
+    def localtrace(self, frame, event, arg):
+        if self.killed:
+            if event == "line":
+                raise SystemExit()
+        return self.localtrace
+
+    def kill(self):
+        self.killed = True
+
+
+# Count frames going through a camera loop
+class FrameCounter:
+    def __init__(self):
+        self.frames = 0
+
+    def __call__(self, *args):
+        self.frames += 1
+
+
+# Frames/sec through `CameraBase._loop_libs_fn` with and without per-line tracing
+def bench_threads(args):
+    load_config()
+    for label in ("cooperative", "settrace") * args.rounds:
+        cam = CameraBase.init_cam(
+            args.camera, timeString, CameraParams(csname=False, videofile=False)
+        )
+        cam.post_init()
+        counter = FrameCounter()
+        libs = make_libs(args.libs)
+        if label == "cooperative":
+            thread = cam.launch_libs_loop(*libs, callback=counter)
+        else:
+            thread = TracedThread(cam._loop_libs_fn, (counter, *libs))
+            thread.start()
+        time.sleep(args.warmup)
+        start_frames = counter.frames
+        start = time.monotonic()
+        time.sleep(args.seconds)
+        frames = counter.frames - start_frames
+        elapsed = time.monotonic() - start
+        cam.kill = True
+        thread.join(1.0)
+        cam.close()
+        print(
+            "{:>12}: {:6d} frames in {:5.2f}s = {:7.2f} FPS".format(
+                label, frames, elapsed, frames / elapsed
+            )
+        )
+
+
+# Run the vision libraries over recorded frames on several "cameras" at once, either on threads in
+# this interpreter or with each camera's libraries in a worker process
+def bench_process(args):
+    load_config()
+    frames = load_video(args.video, args.frames)
+    h, w = frames[0].shape[:2]
+    fov = args.fov
+
+    for mode in ("thread", "process") * args.rounds:
+        stop = threading.Event()
+        counts = [0] * args.cams
+        procs = []
+
+        def run(n: int):
+            libs = make_libs(args.libs)
+            if mode == "process":
+                proc = VisionProcess(libs, (h, w, 3), name=f"bench{n}")
+                procs.append(proc)
+            i = n
+            while not stop.is_set():
+                frame = frames[i % len(frames)]
+                if mode == "process":
+                    proc.find_objects(frame, w, h, fov)
+                else:
+                    for lib in libs:
+                        lib.find_objects(frame, w, h, fov)
+                counts[n] += 1
+                i += 1
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(args.cams)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        start_frames = sum(counts)
+        start = time.monotonic()
+        time.sleep(args.seconds)
+        frames_done = sum(counts) - start_frames
+        elapsed = time.monotonic() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for proc in procs:
+            proc.close()
+        print(
+            "{:>8} x{}: {:6d} frames in {:5.2f}s = {:7.2f} FPS total".format(
+                mode, args.cams, frames_done, elapsed, frames_done / elapsed
+            )
+        )
+
+
+# A frame of noise with some ring-colored bars on it
+def synthetic_frame(width: int, height: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 60, (height, width, 3), dtype=np.uint8)
+    for _ in range(8):
+        x = int(rng.integers(0, width - width // 8))
+        y = int(rng.integers(0, height - height // 30))
+        cv.rectangle(
+            frame, (x, y), (x + width // 8, y + height // 30), (0, 100, 255), -1
+        )
+    return frame
+
+
+# `VisionBase.process_image_contours` as it was before it used scratch buffers, for comparison
+def process_image_contours_alloc(imgRaw, hsvMin, hsvMax, erodeDilate, useCanny):
+    blur = cv.GaussianBlur(imgRaw, (13, 13), 0)
+    hsv = cv.cvtColor(blur, cv.COLOR_BGR2HSV)
+    mask = cv.inRange(hsv, hsvMin, hsvMax)
+    edges = cv.Canny(mask, 35, 125) if useCanny else mask
+    if erodeDilate:
+        kernel = np.ones((3, 3), np.uint8)
+        erode = cv.erode(edges, kernel, iterations=2)
+        edges = cv.dilate(erode, kernel, iterations=2)
+    contours, _ = cv.findContours(edges, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    return list(contours)
+
+
+# Time per call and transient memory per call of the contour pipeline, with and without scratch buffers
+# numpy doesn't expose an allocation counter, so allocations are measured as the peak number of bytes
+# traced by `tracemalloc` during a call, above what was already allocated
+def bench_contours(args):
+    load_config()
+    lib = RingVisionLibrary()
+    hsvMin = (lib.cfg("HMIN", 0, int), lib.cfg("SMIN", 0, int), lib.cfg("VMIN", 0, int))
+    hsvMax = (
+        lib.cfg("HMAX", 255, int),
+        lib.cfg("SMAX", 255, int),
+        lib.cfg("VMAX", 255, int),
+    )
+    flags = (args.erode_dilate, args.canny)
+
+    def reused(frame):
+        new_frame(frame)
+        return lib.process_image_contours(frame, hsvMin, hsvMax, *flags)
+
+    def allocating(frame):
+        return process_image_contours_alloc(frame, hsvMin, hsvMax, *flags)
+
+    for size in args.sizes.split(","):
+        width, height = map(int, size.split("x"))
+        frame = synthetic_frame(width, height)
+        for label, fn in (("allocating", allocating), ("scratch", reused)):
+            fn(frame)
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn(frame)
+            per_call = (time.perf_counter() - start) / args.calls
+
+            tracemalloc.start()
+            peaks = []
+            for _ in range(min(args.calls, 20)):
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                fn(frame)
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+            tracemalloc.stop()
+            print(
+                "{:>4}x{:<4} {:>10}: {:7.3f} ms/call, {:9.1f} KiB transient/call".format(
+                    width, height, label, per_call * 1000, np.median(peaks) / 1024
+                )
+            )
+
+
+# Intersection over union of two (x, y, w, h) boxes
+def iou(a, b) -> float:
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(x1 - x0, 0) * max(y1 - y0, 0)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+# Time and detection recall of a library with each blur setting, on recorded frames
+# Recall is measured against the detections made with the first setting (the reference): a reference
+# detection counts as found if the other setting has a detection overlapping it with IoU >= --iou
+def bench_blur(args):
+    load_config()
+    frames = load_video(args.video, args.frames)
+    h, w = frames[0].shape[:2]
+    lib = vision_libs[args.lib]()
+    specs = [spec.split(":") for spec in args.settings.split(",")]
+
+    reference = None
+    for kind, size, scale in specs:
+        # The blur is compiled into the library's parameters, so they have to be recompiled for each setting
+        VisionBase.update_config(
+            lib.name, {"BLUR": kind, "BLUR_SIZE": size, "BLUR_SCALE": scale}, [lib]
+        )
+        results = []
+        start = time.perf_counter()
+        for frame in frames:
+            new_frame(frame)
+            results.append(
+                [(o.x, o.y, o.w, o.h) for o in lib.find_objects(frame, w, h, args.fov)]
+            )
+        per_frame = (time.perf_counter() - start) / len(frames)
+        if reference is None:
+            reference = results
+        found = sum(
+            1
+            for ref, res in zip(reference, results)
+            for box in ref
+            if any(iou(box, other) >= args.iou for other in res)
+        )
+        total = sum(map(len, reference))
+        extra = sum(map(len, results)) - found
+        print(
+            "{:>8} size {:>2} scale {}: {:7.3f} ms/frame, recall {:6.1%} ({}/{}), {} extra".format(
+                kind,
+                size,
+                scale,
+                per_frame * 1000,
+                found / total if total > 0 else 1.0,
+                found,
+                total,
+                max(extra, 0),
+            )
+        )
+
+
+# AprilTag detections laid out in a grid, shaped like `pyapriltags.Detection`
+def synthetic_tags(count: int, width: int, height: int) -> List[SimpleNamespace]:
+    cols = math.ceil(math.sqrt(count))
+    size = width / (cols * 2)
+    tags = []
+    for i in range(count):
+        cx = (i % cols + 0.5) * width / cols
+        cy = (i // cols + 0.5) * height / cols
+        pts = np.array(
+            [[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64
+        ) * size / 2 + (cx, cy)
+        tags.append(SimpleNamespace(corners=pts, center=np.array([cx, cy]), tag_id=i))
+    return tags
+
+
+# The AprilTag conversion as it was before intrinsics were cached, one tag at a time, for comparison
+def cvt_res_uncached(r, cameraWidth, cameraHeight, cameraFOV):
+    f = 0.5 / math.tan(cameraFOV * math.pi / 360) * cameraWidth
+    camMat = np.array([[f, 0, cameraWidth // 2], [0, f, cameraHeight // 2], [0, 0, 1]])
+    xs = sorted([c[0] for c in r.corners])
+    ys = sorted([c[1] for c in r.corners])
+    w = int(xs[-1] - xs[0])
+    h = int(ys[-1] - ys[0])
+    x = int(r.center[0] - w // 2)
+    y = int(r.center[1] - h // 2)
+    obj = populate_obj(
+        FoundObject("TAG", x, y, w=w, h=h, ident=r.tag_id),
+        6.5,
+        cameraWidth,
+        cameraHeight,
+        cameraFOV,
+    )
+    good, _, pose_t = cv.solvePnP(
+        tag_corners, r.corners, camMat, None, flags=cv.SOLVEPNP_IPPE_SQUARE
+    )
+    if good:
+        obj.distance = math.sqrt(np.sum(np.square(pose_t)))
+    return obj
+
+
+# Time to turn a frame's AprilTag detections into FoundObjects, for a few tag counts
+def bench_tags(args):
+    w, h, fov = args.width, args.height, args.fov
+    for count in map(int, args.counts.split(",")):
+        tags = synthetic_tags(count, w, h)
+        for label, fn in (
+            ("per-tag", lambda: [cvt_res_uncached(r, w, h, fov) for r in tags]),
+            ("batched", lambda: cvt_results(tags, w, h, fov)),
+        ):
+            fn()
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn()
+            per_call = (time.perf_counter() - start) / args.calls
+            print(
+                "{:3d} tags {:>8}: {:8.1f} us/frame, {:6.1f} us/tag".format(
+                    count, label, per_call * 1e6, per_call * 1e6 / count
+                )
+            )
+
+
+# Distance, angle and offset of many found objects, one at a time vs all at once
+def bench_populate(args):
+    w, h, fov = args.width, args.height, args.fov
+    rng = np.random.default_rng(0)
+    for count in map(int, args.counts.split(",")):
+        xs = rng.integers(0, w - 40, count).tolist()
+        ws = rng.integers(10, 40, count).tolist()
+
+        def scalar():
+            return [
+                populate_obj(FoundObject("RING", x, 0, w=bw, h=bw), 14.0, w, h, fov)
+                for x, bw in zip(xs, ws)
+            ]
+
+        def batched():
+            distances, angles, offsets = populate_metrics(xs, ws, 14.0, w, fov)
+            return [
+                FoundObject(
+                    "RING", x, 0, w=bw, h=bw, distance=d, angle=a, offset=o
+                )
+                for x, bw, d, a, o in zip(
+                    xs, ws, distances.tolist(), angles.tolist(), offsets.tolist()
+                )
+            ]
+
+        for a, b in zip(scalar(), batched()):
+            assert math.isclose(a.distance, b.distance) and math.isclose(
+                a.angle, b.angle, abs_tol=1e-9
+            )
+        for label, fn in (("scalar", scalar), ("batched", batched)):
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn()
+            per_call = (time.perf_counter() - start) / args.calls
+            print(
+                "{:3d} objects {:>8}: {:8.1f} us/frame, {:6.2f} us/object".format(
+                    count, label, per_call * 1e6, per_call * 1e6 / count
+                )
+            )
+
+
+# Fields of `FoundObject`, as the worker process used to send them back one tuple per object
+object_record_fields = (
+    "x",
+    "y",
+    "w",
+    "h",
+    "radius",
+    "distance",
+    "angle",
+    "offset",
+    "percent",
+    "ident",
+)
+
+
+# Making a frame's results and sending them back from a worker process: a list of `FoundObject`s packed
+# as tuples vs a `FoundObjects` array packed as bytes
+def bench_results(args):
+    rng = np.random.default_rng(0)
+    for count in map(int, args.counts.split(",")):
+        cols = {
+            "x": rng.integers(0, 800, count),
+            "y": rng.integers(0, 600, count),
+            "w": rng.integers(10, 40, count),
+            "h": rng.integers(10, 40, count),
+            "distance": rng.random(count) * 100,
+            "angle": rng.random(count) * 40 - 20,
+            "offset": rng.random(count) * 20 - 10,
+        }
+        lists = {name: col.tolist() for name, col in cols.items()}
+
+        def objects():
+            objs = [
+                FoundObject("RING", x, y, w=w, h=h, distance=d, angle=a, offset=o)
+                for x, y, w, h, d, a, o in zip(*lists.values())
+            ]
+            data = pickle.dumps(
+                [(o.ty, *(getattr(o, f) for f in object_record_fields)) for o in objs]
+            )
+            return data, [
+                FoundObject(ty, x, y, **dict(zip(object_record_fields[2:], rest)))
+                for ty, x, y, *rest in pickle.loads(data)
+            ]
+
+        def records():
+            found = FoundObjects("RING", count=count)
+            for name, col in cols.items():
+                found.records[name] = col
+            data = pickle.dumps(pack_objects(found))
+            return data, unpack_objects(pickle.loads(data))
+
+        for label, fn in (("objects", objects), ("records", records)):
+            data, _ = fn()
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn()
+            per_call = (time.perf_counter() - start) / args.calls
+            print(
+                "{:3d} objects {:>8}: {:8.1f} us/frame, {:6d} bytes/frame".format(
+                    count, label, per_call * 1e6, len(data)
+                )
+            )
+
+
+# `find_objects` on a frame with nothing in it, so the per-frame overhead isn't hidden by the contour work
+# Recompiling the parameters every frame is what reading the settings in `find_objects` used to cost
+# Each is timed as the best of a few rounds, since the difference is small next to scheduling noise
+def bench_params(args):
+    load_config()
+    for libName in args.libs.split(","):
+        lib = vision_libs[libName]()
+        for size in args.sizes.split(","):
+            w, h = map(int, size.split("x"))
+            frame = np.zeros((h, w, 3), dtype=np.uint8)
+
+            def per_frame():
+                lib.reload()
+                new_frame(frame)
+                return lib.find_objects(frame, w, h, args.fov)
+
+            def compiled():
+                new_frame(frame)
+                return lib.find_objects(frame, w, h, args.fov)
+
+            for label, fn in (
+                ("per-frame", per_frame),
+                ("compiled", compiled),
+                ("compile", lib.compile_params),
+            ):
+                fn()
+                best = math.inf
+                for _ in range(args.rounds):
+                    start = time.perf_counter()
+                    for _ in range(args.calls):
+                        fn()
+                    best = min(best, time.perf_counter() - start)
+                print(
+                    "{:>6} {:>9} {:>10}: {:8.1f} us/call".format(
+                        libName, size, label, best / args.calls * 1e6
+                    )
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    threads = sub.add_parser("threads", help="cooperative vs settrace cancellation")
+    threads.add_argument("--camera", default="DUMMY")
+    threads.add_argument("--libs", default="RING,APRIL")
+    threads.add_argument("--seconds", type=float, default=5.0)
+    threads.add_argument("--warmup", type=float, default=1.0)
+    threads.add_argument("--rounds", type=int, default=2)
+    threads.set_defaults(fn=bench_threads)
+
+    process = sub.add_parser("process", help="thread vs worker process vision")
+    process.add_argument("--video", default=None)
+    process.add_argument("--frames", type=int, default=300)
+    process.add_argument("--fov", type=float, default=43.0)
+    process.add_argument("--cams", type=int, default=2)
+    process.add_argument("--libs", default="RING,APRIL")
+    process.add_argument("--seconds", type=float, default=10.0)
+    process.add_argument("--warmup", type=float, default=1.0)
+    process.add_argument("--rounds", type=int, default=1)
+    process.set_defaults(fn=bench_process)
+
+    contours = sub.add_parser("contours", help="contour pipeline buffer reuse")
+    contours.add_argument("--sizes", default="640x480,800x600")
+    contours.add_argument("--calls", type=int, default=200)
+    contours.add_argument("--erode-dilate", action="store_true")
+    contours.add_argument("--canny", action="store_true")
+    contours.set_defaults(fn=bench_contours)
+
+    blur = sub.add_parser("blur", help="blur settings: time and recall")
+    blur.add_argument("--video", default=None)
+    blur.add_argument("--frames", type=int, default=300)
+    blur.add_argument("--fov", type=float, default=43.0)
+    blur.add_argument("--lib", default="RING")
+    blur.add_argument("--iou", type=float, default=0.5)
+    blur.add_argument(
+        "--settings",
+        default="GAUSSIAN:13:1,GAUSSIAN:7:1,BOX:13:1,BOX:7:1,STACK:13:1,NONE:0:1,"
+        "GAUSSIAN:13:2,BOX:13:2,GAUSSIAN:13:4",
+        help="comma-separated KIND:SIZE:SCALE, the first is the reference",
+    )
+    blur.set_defaults(fn=bench_blur)
+
+    tags = sub.add_parser("tags", help="AprilTag detection conversion")
+    tags.add_argument("--counts", default="1,4,16")
+    tags.add_argument("--calls", type=int, default=2000)
+    tags.add_argument("--width", type=int, default=800)
+    tags.add_argument("--height", type=int, default=600)
+    tags.add_argument("--fov", type=float, default=48.5)
+    tags.set_defaults(fn=bench_tags)
+
+    populate = sub.add_parser("populate", help="distance/angle of found objects")
+    populate.add_argument("--counts", default="1,8,32,64")
+    populate.add_argument("--calls", type=int, default=2000)
+    populate.add_argument("--width", type=int, default=800)
+    populate.add_argument("--height", type=int, default=600)
+    populate.add_argument("--fov", type=float, default=48.5)
+    populate.set_defaults(fn=bench_populate)
+
+    results = sub.add_parser("results", help="found object containers")
+    results.add_argument("--counts", default="1,8,32,64")
+    results.add_argument("--calls", type=int, default=2000)
+    results.set_defaults(fn=bench_results)
+
+    params = sub.add_parser("params", help="settings lookups in find_objects")
+    params.add_argument("--libs", default="RING,APRIL")
+    params.add_argument("--sizes", default="16x12,32x24")
+    params.add_argument("--calls", type=int, default=1000)
+    params.add_argument("--rounds", type=int, default=5)
+    params.add_argument("--fov", type=float, default=48.5)
+    params.set_defaults(fn=bench_params)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()